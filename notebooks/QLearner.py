@@ -1,19 +1,319 @@
 """Implement QLearner, a Reinforcement Learning class"""
 
 import numpy as np
-import random as rand
-from copy import deepcopy
-from collections import deque
+from heapq import heappush, heappop
+from util import save_bundle, load_bundle
+
+class RandomStream(object):
+
+    def __init__(self, seed=None, block_size=4096):
+        """The constructor RandomStream() creates a source of random numbers that
+        draws block_size uniforms at a time from its own numpy Generator and 
+        hands them out one by one or in bulk, drawing a new block when the 
+        current one runs out. Integers are derived from the same uniforms.
+
+        Parameters:
+        seed: int, the seed of the Generator. Streams with the same seed produce
+              the same numbers
+        block_size: int, the number of uniforms drawn at a time
+        """
+        self.rng = np.random.default_rng(seed)
+        self.block_size = block_size
+        self.refill()
+
+    def refill(self):
+        """Draw a new block of uniforms."""
+        self.block = self.rng.random(self.block_size)
+        # Handing out Python floats from a list is faster than numpy scalars
+        self.block_list = self.block.tolist()
+        self.next = 0
+
+    def random(self, size=None):
+        """Return a uniform float in [0, 1), or an array of size of them."""
+        if size is None:
+            if self.next == self.block_size:
+                self.refill()
+            self.next += 1
+            return self.block_list[self.next - 1]
+        parts = []
+        while size > 0:
+            if self.next == self.block_size:
+                self.refill()
+            n = min(size, self.block_size - self.next)
+            parts.append(self.block[self.next:self.next + n])
+            self.next += n
+            size -= n
+        return np.concatenate(parts) if parts else np.zeros(0)
+
+    def integers(self, low, high, size=None):
+        """Return a uniform int in [low, high), or an array of size of them."""
+        if size is None:
+            return low + int(self.random() * (high - low))
+        return low + (self.random(size) * (high - low)).astype(np.int64)
+
+
+class SparseTable(object):
+
+    def __init__(self, num_actions, default=0.0, capacity=1024):
+        """The constructor SparseTable() creates a table of num_actions values for
+        each state that only reserves space for the states that are written to. 
+        States are mapped to rows of a 2-d numpy array which doubles in size when
+        it is full. Row 0 holds the default values and is read for states that 
+        have never been written to. Like a numpy array, the table can be indexed 
+        with table[s, a], table[s, :] or table[s], where s and a are ints or 
+        arrays of ints.
+
+        Parameters:
+        num_actions: int, the number of actions available
+        default: float, the value of every action in a state never written to
+        capacity: int, the initial number of rows
+        """
+        self.num_actions = num_actions
+        self.default = default
+        # Map each state to its row in values
+        self.rows = {}
+        self.values = np.full(shape=(capacity, num_actions), fill_value=default)
+
+    @property
+    def shape(self):
+        return (len(self.rows), self.num_actions)
+
+    def lookup(self, s, create=False):
+        """Return the row (or an array of rows) of state s. States that have 
+        never been written to get row 0, or a new row if create is True.
+        """
+        if np.ndim(s) > 0:
+            return np.array([self.lookup(x, create) for x in np.ravel(s).tolist()],
+                            dtype=np.int64).reshape(np.shape(s))
+        row = self.rows.get(int(s), 0)
+        if row == 0 and create:
+            row = len(self.rows) + 1
+            if row == len(self.values):
+                self.values = np.concatenate([self.values, 
+                                              np.full_like(self.values, 
+                                                           self.default)])
+            self.rows[int(s)] = row
+        return row
+
+    def __getitem__(self, key):
+        s, a = key if isinstance(key, tuple) else (key, slice(None))
+        return self.values[self.lookup(s), a]
+
+    def __setitem__(self, key, value):
+        s, a = key if isinstance(key, tuple) else (key, slice(None))
+        # Look up first: creating rows may replace self.values with a larger 
+        # array
+        rows = self.lookup(s, create=True)
+        self.values[rows, a] = value
+
+    def get_arrays(self):
+        """Return a dictionary of the arrays that make up the table."""
+        return {"values": self.values, 
+                "states": np.array(list(self.rows), dtype=np.int64)}
+
+    @classmethod
+    def from_arrays(cls, arrays, default=0.0):
+        """Create a table from the arrays returned by get_arrays()."""
+        table = cls(arrays["values"].shape[1], default=default, capacity=1)
+        table.values = arrays["values"]
+        table.rows = {s: row + 1 for row, s in enumerate(arrays["states"].tolist())}
+        return table
+
+    def __array__(self, dtype=None):
+        """Return the values of the states that have been written to, in the
+        order they were first written to.
+        """
+        return np.asarray(self.values[1:len(self.rows) + 1], dtype=dtype)
+
+
+class TransitionModel(object):
+
+    def __init__(self, num_states, num_actions, width=4, sparse=False):
+        """The constructor TransitionModel() reserves space for counting the 
+        transitions from s to s_prime when taking action a. Each (s, a) pair owns 
+        a row of successor slots; all rows grow together when one of them runs 
+        out of slots, so memory is num_rows * width.
+
+        Parameters:
+        num_states: int, the number of states to consider. Ignored if sparse
+        num_actions: int, the number of actions available
+        width: int, the initial number of successor slots of each (s, a) pair
+        sparse: boolean, if True, rows are only reserved for the (s, a) pairs 
+                that have been experienced, and row 0 is left empty for the 
+                pairs that have not. Otherwise there is a row for every pair.
+        """
+        self.num_states = num_states
+        self.num_actions = num_actions
+        self.sparse = sparse
+        if sparse:
+            # Map each experienced (s, a) to its row, and each row to its (s, a)
+            self.rows = {}
+            num_rows = 1024
+            self.row_states = np.zeros(shape=num_rows, dtype=np.int64)
+            self.row_actions = np.zeros(shape=num_rows, dtype=np.int64)
+        else:
+            num_rows = num_states * num_actions
+        # s_prime observed in each slot (-1 if the slot is empty) and its count
+        self.successors = np.full(shape=(num_rows, width), fill_value=-1, 
+                                  dtype=np.int64)
+        self.counts = np.zeros(shape=(num_rows, width), dtype=np.int64)
+        # The number of slots in use for each (s, a)
+        self.num_successors = np.zeros(shape=num_rows, dtype=np.int64)
+        # The most common s_prime (-1 if never seen) for each (s, a) and the slot
+        # it lives in
+        self.best = np.full(shape=num_rows, fill_value=-1, dtype=np.int64)
+        self.best_slot = np.zeros(shape=num_rows, dtype=np.int64)
+        # The (s, a) pairs that have led to each s_prime, and the same as arrays
+        # of states and of actions, built when first needed
+        self.predecessors = {}
+        self.predecessor_arrays = {}
+
+    def row(self, s, a, create=False):
+        """Return the row (or an array of rows) of (s, a). In a sparse model, 
+        pairs that have not been experienced get row 0, or a new row if create 
+        is True.
+        """
+        if not self.sparse:
+            return s * self.num_actions + a
+        if np.ndim(s) > 0:
+            return np.array([self.rows.get(key, 0) for key in 
+                             zip(np.ravel(s).tolist(), np.ravel(a).tolist())], 
+                            dtype=np.int64).reshape(np.shape(s))
+        row = self.rows.get((s, a), 0)
+        if row == 0 and create:
+            row = len(self.rows) + 1
+            if row == len(self.best):
+                self._grow_rows()
+            self.rows[(s, a)] = row
+            self.row_states[row] = s
+            self.row_actions[row] = a
+        return row
+
+    def add(self, s, a, s_prime):
+        """Record a transition from s to s_prime when taking action a, and keep 
+        the most common s_prime of (s, a) up to date.
+        """
+        row = self.row(s, a, create=True)
+        n = self.num_successors[row]
+        slot = np.flatnonzero(self.successors[row, :n] == s_prime)
+        if len(slot) > 0:
+            slot = slot[0]
+        else:
+            if n == self.successors.shape[1]:
+                self._grow()
+            slot = n
+            self.successors[row, slot] = s_prime
+            self.num_successors[row] += 1
+            self.predecessors.setdefault(s_prime, set()).add((s, a))
+            self.predecessor_arrays.pop(s_prime, None)
+        self.counts[row, slot] += 1
+
+        # Only the incremented count can overtake the current best. Ties go to
+        # the s_prime that was seen first, i.e. the one in the lower slot
+        best_slot = self.best_slot[row]
+        count, best_count = self.counts[row, slot], self.counts[row, best_slot]
+        if self.best[row] < 0 or count > best_count or (count == best_count 
+                                                         and slot < best_slot):
+            self.best[row] = s_prime
+            self.best_slot[row] = slot
+
+    def get_predecessors(self, s_prime):
+        """Return two arrays with the states and actions of the (s, a) pairs 
+        that have led to s_prime."""
+        arrays = self.predecessor_arrays.get(s_prime)
+        if arrays is None:
+            pairs = self.predecessors.get(s_prime, ())
+            arrays = (np.array([s for s, _ in pairs], dtype=np.int64),
+                      np.array([a for _, a in pairs], dtype=np.int64))
+            self.predecessor_arrays[s_prime] = arrays
+        return arrays
+
+    def best_successor(self, s, a):
+        """Return the most common s_prime (-1 if never seen) as a result of 
+        taking a in s. s and a can be ints or arrays of the same shape.
+        """
+        return self.best[self.row(s, a)]
+
+    def sample(self, n, stream):
+        """Draw n (s, a) pairs uniformly at random from a RandomStream. A dense 
+        model draws from all pairs, a sparse one from the experienced pairs only.
+
+        Returns: Two arrays with the states and actions of the pairs
+        """
+        if not self.sparse:
+            return (stream.integers(0, self.num_states, size=n),
+                    stream.integers(0, self.num_actions, size=n))
+        if not self.rows:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+        rows = stream.integers(1, len(self.rows) + 1, size=n)
+        return self.row_states[rows], self.row_actions[rows]
+
+    def get_arrays(self):
+        """Return a dictionary of the arrays that make up the model."""
+        arrays = {"successors": self.successors, "counts": self.counts,
+                  "num_successors": self.num_successors, "best": self.best,
+                  "best_slot": self.best_slot}
+        if self.sparse:
+            arrays["row_states"] = self.row_states
+            arrays["row_actions"] = self.row_actions
+        return arrays
+
+    @classmethod
+    def from_arrays(cls, num_states, num_actions, arrays, sparse=False):
+        """Create a model from the arrays returned by get_arrays(), and rebuild 
+        the index of the experienced (s, a) pairs and their predecessors.
+        """
+        # Construct with no states so that no arrays are allocated only to be 
+        # replaced, and copy the given arrays only if they are read-only
+        model = cls(0, num_actions, width=1, sparse=sparse)
+        model.num_states = num_states
+        for name, array in arrays.items():
+            setattr(model, name, np.require(array, requirements="W"))
+        for row in np.flatnonzero(model.num_successors).tolist():
+            if sparse:
+                s, a = int(model.row_states[row]), int(model.row_actions[row])
+                model.rows[(s, a)] = row
+            else:
+                s, a = divmod(row, num_actions)
+            for s_prime in model.successors[row, :model.num_successors[row]]:
+                model.predecessors.setdefault(int(s_prime), set()).add((s, a))
+        return model
+
+    def _grow(self):
+        """Double the number of successor slots of every (s, a) pair."""
+        width = self.successors.shape[1]
+        self.successors = np.pad(self.successors, ((0, 0), (0, width)), 
+                                 constant_values=-1)
+        self.counts = np.pad(self.counts, ((0, 0), (0, width)))
+
+    def _grow_rows(self):
+        """Double the number of rows of a sparse model."""
+        num_rows = len(self.best)
+        self.successors = np.pad(self.successors, ((0, num_rows), (0, 0)), 
+                                 constant_values=-1)
+        self.counts = np.pad(self.counts, ((0, num_rows), (0, 0)))
+        self.num_successors = np.pad(self.num_successors, (0, num_rows))
+        self.best = np.pad(self.best, (0, num_rows), constant_values=-1)
+        self.best_slot = np.pad(self.best_slot, (0, num_rows))
+        self.row_states = np.pad(self.row_states, (0, num_rows))
+        self.row_actions = np.pad(self.row_actions, (0, num_rows))
+
+    def __contains__(self, key):
+        s, a = key
+        return self.num_successors[self.row(s, a)] > 0
+
 
 class QLearner(object):
 
     def __init__(self, num_states=100, num_actions=4, alpha=0.2,
-        gamma=0.9, rar=0.5, radr=0.99, dyna=0, verbose=False):
+        gamma=0.9, rar=0.5, radr=0.99, dyna=0, planning="uniform", theta=3.0,
+        memory_size=2000, q_table="dense", seed=None, verbose=False):
         """The constructor QLearner() reserves space for keeping track of Q[s, a] for 
         the number of states and actions. It initializes Q[] with all zeros.
 
         Parameters:
-        num_states: int, the number of states to consider
+        num_states: int, the number of states to consider. Only used by the dense
+                    Q table, where states must be less than num_states
         num_actions: int, the number of actions available
         alpha: float, the learning rate used in the update rule. 
                Should range between 0.0 and 1.0 with 0.2 as a typical value
@@ -26,6 +326,22 @@ class QLearner(object):
               Ranges between 0.0 (immediate decay to 0) and 1.0 (no decay). Typically 0.99.
         dyna: int, conduct this number of dyna updates for each regular update. 
               When Dyna is used, 200 is a typical value.
+        planning: str, how Dyna-Q picks the (s, a) pairs to update. "uniform" draws
+                  them at random; "prioritized" uses prioritized sweeping, where
+                  dyna is the maximum number of updates for each regular update.
+        theta: float, the smallest TD error for which prioritized sweeping queues 
+               an (s, a) pair, as a fraction of the average absolute reward 
+               received so far, so that it does not depend on the scale of 
+               the rewards. With 3.0, only surprises of a few typical rewards
+               are swept backwards.
+        memory_size: int, the number of most recent transitions kept for 
+                     experience replay
+        q_table: str, how Q, R and the transition model are stored. "dense" 
+                 reserves space for every state up front; "sparse" only for the 
+                 states that are visited, so states can be any non-negative int.
+                 Uniform Dyna-Q then draws from the experienced (s, a) pairs.
+        seed: int, the seed of the random numbers used for exploration, planning
+              and replay. Learners with the same seed make the same choices.
         verbose: boolean, if True, your class is allowed to print debugging 
                  statements, if False, all printing is prohibited.
         """        
@@ -36,8 +352,18 @@ class QLearner(object):
         self.rar = rar
         self.radr = radr
         self.dyna = dyna
+        self.planning = planning
+        self.theta = theta
         self.verbose = verbose
-        self.memory = deque(maxlen=2000)
+        self.seed = seed
+        self.random = RandomStream(seed)
+        # Keep the latest memory_size transitions in a ring buffer for experience
+        # replay. memory_next is the slot the next transition is written to
+        self.memory = np.zeros(shape=memory_size, dtype=[("s", np.int64), 
+            ("a", np.int64), ("r", np.float64), ("s_prime", np.int64), 
+            ("done", np.bool_)])
+        self.memory_len = 0
+        self.memory_next = 0
 
         # Keep track of the latest state and action which are initialized to 0
         self.s = 0
@@ -45,15 +371,37 @@ class QLearner(object):
         
         # Initialize a Q table which records and updates Q value for
         # each action in each state
-        self.Q = np.zeros(shape=(num_states, num_actions))
+        self.q_table = q_table
+        sparse = q_table == "sparse"
+        if sparse:
+            self.Q = SparseTable(num_actions)
+        else:
+            self.Q = np.zeros(shape=(num_states, num_actions))
         # Keep track of the number of transitions from s to s_prime for when taking 
         # an action a when doing Dyna-Q
-        self.T = {}
+        self.T = TransitionModel(num_states, num_actions, sparse=sparse)
         # Keep track of reward for each action in each state when doing Dyna-Q
-        self.R = np.zeros(shape=(num_states, num_actions))
+        if sparse:
+            self.R = SparseTable(num_actions)
+        else:
+            self.R = np.zeros(shape=(num_states, num_actions))
+        # A max-heap of (-priority, s, a) for prioritized sweeping, and the 
+        # priority each queued (s, a) currently has
+        self.queue = []
+        self.priorities = {}
+        # The average absolute reward, which theta is relative to
+        self.reward_scale = 0.0
+        self.num_rewards = 0
+        # The number of hallucinated updates of the Q table made by planning
+        self.planning_updates = 0
 
     def remember(self, state, action, reward, next_state, done):
-        self.memory.append((state, action, reward, next_state, done))
+        """Store a transition in the replay memory, overwriting the oldest one
+        once the memory is full.
+        """
+        self.memory[self.memory_next] = (state, action, reward, next_state, done)
+        self.memory_next = (self.memory_next + 1) % len(self.memory)
+        self.memory_len = min(self.memory_len + 1, len(self.memory))
 
     def act(self, s, r, done=False, update=True):
         if update:
@@ -71,8 +419,8 @@ class QLearner(object):
         
         Returns: The selected action to take in s
         """
-        if rand.uniform(0.0, 1.0) < self.rar:
-            action = rand.randint(0, self.num_actions - 1)
+        if self.random.random() < self.rar:
+            action = self.random.integers(0, self.num_actions)
         else:
             action = self.Q[s, :].argmax()
 
@@ -105,28 +453,15 @@ class QLearner(object):
             self.R[self.s, self.a] = (1 - self.alpha) * self.R[self.s, self.a] \
                                         + self.alpha * r
             
-            if (self.s, self.a) in self.T:
-                if s_prime in self.T[(self.s, self.a)]:
-                    self.T[(self.s, self.a)][s_prime] += 1
-                else:
-                    self.T[(self.s, self.a)][s_prime] = 1
+            self.T.add(self.s, self.a, s_prime)
+            if self.planning == "prioritized":
+                self.num_rewards += 1
+                self.reward_scale += (abs(r) - self.reward_scale) \
+                                     / self.num_rewards
+                self.plan_prioritized()
             else:
-                self.T[(self.s, self.a)] = {s_prime: 1}
-            
-            Q = deepcopy(self.Q)
-            for i in range(self.dyna):
-                s = rand.randint(0, self.num_states - 1)
-                a = rand.randint(0, self.num_actions - 1)
-                if (s, a) in self.T:
-                    # Find the most common s_prime as a result of taking a in s
-                    s_pr = max(self.T[(s, a)], key=lambda k: self.T[(s, a)][k])
-                    # Update the temporary Q table
-                    Q[s, a] = (1 - self.alpha) * Q[s, a] \
-                                + self.alpha * (self.R[s, a] + self.gamma 
-                                * Q[s_pr, Q[s_pr, :].argmax()])
-            # Update the Q table of the learner once Dyna-Q is complete
-            self.Q = deepcopy(Q)
-        
+                self.plan()
+
         # Find the next action to take and update the latest state and action
         a_prime = self.query_set_state(s_prime)
         self.rar *= self.radr
@@ -134,5 +469,278 @@ class QLearner(object):
             print ("s =", s_prime,"a =",a_prime,"r =",r)
         return a_prime
 
-    def replay(self, batch_size=32):
+    def plan(self):
+        """Conduct self.dyna hallucinated updates of the Q table in one batch.
+
+        All (s, a) pairs are drawn at once and only those that have been 
+        experienced are updated, using the modelled reward R[s, a] and the most 
+        common s_prime. The targets are computed from the Q table as it was 
+        before planning; a pair drawn k times is updated as if the update rule 
+        were applied k times in a row.
+        """
+        s, a = self.T.sample(self.dyna, self.random)
+        s_pr = self.T.best_successor(s, a)
+        experienced = s_pr >= 0
+        if not experienced.any():
+            return
+        s, a, s_pr = s[experienced], a[experienced], s_pr[experienced]
+        self.planning_updates += len(s)
+
+        # Collapse repeated draws of the same (s, a)
+        _, first, counts = np.unique(s * self.num_actions + a, 
+                                     return_index=True, return_counts=True)
+        s, a, s_pr = s[first], a[first], s_pr[first]
+        target = self.R[s, a] + self.gamma * self.Q[s_pr, :].max(axis=1)
+        keep = (1 - self.alpha) ** counts
+        self.Q[s, a] = keep * self.Q[s, a] + (1 - keep) * target
+
+    def plan_prioritized(self):
+        """Conduct up to self.dyna hallucinated updates of the Q table by 
+        prioritized sweeping.
+
+        The latest (s, a) and the predecessors of s, whose targets depend on the
+        value of s that was just updated, are queued by their TD error. Each 
+        planning update pops the pair with the largest error and queues the 
+        predecessors of its state in turn, so that updates spread backwards from 
+        the states whose values changed. Planning stops early once no queued 
+        error is above self.theta times the average absolute reward.
+        """
+        self.prioritize(self.s, self.a)
+        self.prioritize(*self.T.get_predecessors(self.s))
+        for i in range(self.dyna):
+            pair = self.pop_priority()
+            if pair is None:
+                break
+            s, a = pair
+            self.planning_updates += 1
+            s_pr = self.T.best_successor(s, a)
+            self.Q[s, a] = (1 - self.alpha) * self.Q[s, a] \
+                            + self.alpha * (self.R[s, a] + self.gamma 
+                            * self.Q[s_pr, :].max())
+            self.prioritize(*self.T.get_predecessors(s))
+
+    def prioritize(self, s, a):
+        """Queue each (s, a) pair by its TD error under the model if the error 
+        exceeds the threshold of self.theta, unless it is queued with a higher 
+        priority already. s and a can be ints or arrays of the same shape.
+        """
+        s, a = np.atleast_1d(s), np.atleast_1d(a)
+        if len(s) == 0:
+            return
+        s_pr = self.T.best_successor(s, a)
+        seen = s_pr >= 0
+        s, a, s_pr = s[seen], a[seen], s_pr[seen]
+        p = np.abs(self.R[s, a] + self.gamma * self.Q[s_pr, :].max(axis=1) 
+                   - self.Q[s, a])
+        queue = p > self.theta * self.reward_scale
+        for s_q, a_q, p_q in zip(s[queue].tolist(), a[queue].tolist(), 
+                                 p[queue].tolist()):
+            if p_q > self.priorities.get((s_q, a_q), 0.0):
+                self.priorities[(s_q, a_q)] = p_q
+                heappush(self.queue, (-p_q, s_q, a_q))
+
+    def pop_priority(self):
+        """Remove and return the queued (s, a) with the highest priority, 
+        skipping entries that were superseded by a higher priority. Return None 
+        if the queue is empty.
+        """
+        while self.queue:
+            p, s, a = heappop(self.queue)
+            if self.priorities.get((s, a)) == -p:
+                del self.priorities[(s, a)]
+                return s, a
         return None
+
+    def save(self, path):
+        """Save the Q table, the reward table, the transition model and the 
+        parameters of the learner to a single file at path.
+        """
+        arrays, header = self.get_bundle()
+        save_bundle(path, arrays, header)
+
+    @classmethod
+    def load(cls, path, mmap=True):
+        """Load a learner saved with save(). If mmap is True, the Q table is 
+        memory-mapped read-only so that processes loading the same file share 
+        it; such a learner can query but not update the Q table.
+        """
+        arrays, header = load_bundle(path, mmap_names=["Q", "Q.values"] 
+                                     if mmap else [])
+        return cls.from_bundle(arrays, header)
+
+    def get_bundle(self):
+        """Return the arrays and the parameters that make up the learner, as 
+        passed to save_bundle().
+        """
+        header = {"num_states": self.num_states, "num_actions": self.num_actions,
+                  "alpha": self.alpha, "gamma": self.gamma, 
+                  "rar": float(self.rar), "radr": self.radr, "dyna": self.dyna,
+                  "planning": self.planning, "theta": self.theta,
+                  "memory_size": len(self.memory), "q_table": self.q_table,
+                  "seed": None if self.seed is None else int(self.seed)}
+        arrays = {}
+        for name in ["Q", "R"]:
+            table = getattr(self, name)
+            if isinstance(table, SparseTable):
+                for key, array in table.get_arrays().items():
+                    arrays["{}.{}".format(name, key)] = array
+            else:
+                arrays[name] = table
+        for key, array in self.T.get_arrays().items():
+            arrays["T.{}".format(key)] = array
+        return arrays, header
+
+    @classmethod
+    def from_bundle(cls, arrays, header):
+        """Create a learner from the arrays and parameters returned by 
+        get_bundle(). The random numbers of the learner restart from its seed.
+        """
+        # Construct with no states so that no dense tables are allocated only
+        # to be replaced by the saved ones
+        learner = cls(**dict(header, num_states=0))
+        learner.num_states = header["num_states"]
+        for name in ["Q", "R"]:
+            if name in arrays:
+                setattr(learner, name, arrays[name])
+            else:
+                setattr(learner, name, SparseTable.from_arrays(
+                    {key[len(name) + 1:]: array for key, array in arrays.items() 
+                     if key.startswith(name + ".")}))
+        learner.T = TransitionModel.from_arrays(learner.num_states, 
+            learner.num_actions, {key[2:]: array for key, array in arrays.items() 
+                                  if key.startswith("T.")}, 
+            sparse=learner.q_table == "sparse")
+        return learner
+
+    def replay(self, batch_size=32):
+        """Update the Q table with a minibatch of transitions sampled from the 
+        replay memory. The targets are computed from the Q table as it was 
+        before the update; updates for the same (s, a) are summed. Nothing is 
+        done until the memory holds at least batch_size transitions.
+
+        Parameters:
+        batch_size: int, the number of transitions to sample
+        """
+        if self.memory_len < batch_size:
+            return
+        batch = self.memory[self.random.integers(0, self.memory_len, 
+                                                 size=batch_size)]
+        s, a = batch["s"], batch["a"]
+        # There is no future value after the last transition of an episode
+        target = batch["r"] + self.gamma * self.Q[batch["s_prime"], :].max(axis=1) \
+                                * ~batch["done"]
+        # Sum the updates of repeated (s, a) pairs, as np.add.at would, so that 
+        # this works for the sparse Q table as well
+        cells, inverse = np.unique(s * self.num_actions + a, return_inverse=True)
+        delta = np.bincount(inverse, weights=self.alpha * (target - self.Q[s, a]))
+        self.Q[cells // self.num_actions, cells % self.num_actions] += delta
+
+
+class BatchQLearner(object):
+
+    def __init__(self, n_agents=10, num_states=100, num_actions=4, alpha=0.2,
+        gamma=0.9, rar=0.5, radr=0.99, seed=None, verbose=False):
+        """The constructor BatchQLearner() reserves space for n_agents independent 
+        Q tables that are queried and updated in lockstep, one call for all 
+        agents. It initializes Q[] with all zeros. Dyna-Q and experience replay 
+        are not supported.
+
+        Parameters:
+        n_agents: int, the number of agents
+        num_states: int, the number of states to consider
+        num_actions: int, the number of actions available
+        alpha: float or array of n_agents floats, the learning rate of each agent
+        gamma: float or array of n_agents floats, the discount rate of each agent
+        rar: float or array of n_agents floats, the random action rate of each agent
+        radr: float or array of n_agents floats, the random action decay rate of 
+              each agent
+        seed: int, the seed of the random number generator used for exploration
+        verbose: boolean, if True, your class is allowed to print debugging 
+                 statements, if False, all printing is prohibited.
+        """
+        self.n_agents = n_agents
+        self.num_states = num_states
+        self.num_actions = num_actions
+        self.alpha = np.broadcast_to(np.asarray(alpha, dtype=float), n_agents)
+        self.gamma = np.broadcast_to(np.asarray(gamma, dtype=float), n_agents)
+        self.rar = np.array(np.broadcast_to(rar, n_agents), dtype=float)
+        self.radr = np.broadcast_to(np.asarray(radr, dtype=float), n_agents)
+        self.verbose = verbose
+        self.rng = np.random.default_rng(seed)
+        self.agents = np.arange(n_agents)
+
+        # Keep track of the latest state and action of each agent
+        self.s = np.zeros(n_agents, dtype=np.int64)
+        self.a = np.zeros(n_agents, dtype=np.int64)
+
+        # Initialize the Q tables of all agents
+        self.Q = np.zeros(shape=(n_agents, num_states, num_actions))
+
+    def act(self, s, r, done=False, update=True):
+        if update:
+            return self.query(s, r, done=done)
+        else:
+            return self.query_set_state(s)
+
+    def query_set_state(self, s):
+        """Find the next action of each agent in its state s without updating 
+        the Q tables.
+
+        Parameters:
+        s: array of n_agents ints, the new state of each agent
+
+        Returns: An array with the selected action of each agent
+        """
+        s = np.asarray(s)
+        explore = self.rng.random(self.n_agents) < self.rar
+        action = np.where(explore, 
+                          self.rng.integers(0, self.num_actions, self.n_agents),
+                          self.Q[self.agents, s, :].argmax(axis=1))
+        self.s = s
+        self.a = action
+        if self.verbose:
+            print ("s =", s, "a =", action)
+        return action
+
+    def query(self, s_prime, r, done=False):
+        """Update the Q table of each agent with its latest state and action, 
+        then find the next action of each agent in its state s_prime.
+
+        Parameters:
+        s_prime: array of n_agents ints, the new state of each agent
+        r: float or array of n_agents floats, the immediate reward of each agent
+
+        Returns: An array with the selected action of each agent
+        """
+        s_prime = np.asarray(s_prime)
+        best = self.Q[self.agents, s_prime, :].max(axis=1)
+        self.Q[self.agents, self.s, self.a] = (1 - self.alpha) \
+            * self.Q[self.agents, self.s, self.a] \
+            + self.alpha * (r + self.gamma * best)
+        a_prime = self.query_set_state(s_prime)
+        self.rar *= self.radr
+        if self.verbose:
+            print ("s =", s_prime, "a =", a_prime, "r =", r)
+        return a_prime
+
+
+def test_code():
+    """Check that a sparse table keeps the values written past its initial 
+    capacity, one state and an array of states at a time."""
+    table = SparseTable(3, capacity=4)
+    for s in range(10):
+        table[s * 10**9, 0] = s
+    table[np.arange(100, 130), 1] = np.arange(30)
+    assert table.shape == (40, 3)
+    assert [table[s * 10**9, 0] for s in range(10)] == list(range(10))
+    assert (table[np.arange(100, 130), 1] == np.arange(30)).all()
+    learner = QLearner(num_states=10**12, num_actions=3, q_table="sparse", 
+                       seed=0)
+    rng = np.random.default_rng(0)
+    learner.query_set_state(0)
+    for _ in range(3000):
+        learner.query(int(rng.integers(10**12)), 1.0)
+    print("SparseTable OK:", learner.Q.shape)
+
+if __name__ == "__main__":
+    test_code()
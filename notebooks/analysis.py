@@ -113,6 +113,34 @@ def get_portfolio_stats(port_val, daily_rf=0.0, samples_per_year=252.0):
     return cr, adr, sddr, sr
 
 
+def get_portfolio_stats_batch(port_vals, daily_rf=0.0, samples_per_year=252.0):
+    """Compute the statistics of get_portfolio_stats() for many portfolios at 
+    once.
+
+    Parameters:
+    port_vals: A 2-d numpy array with the value of each portfolio (first 
+    dimension) on each day (second dimension)
+    daily_rf: Daily risk-free rate, assuming it does not change
+    samples_per_year: Sampling frequency per year
+
+    Returns:
+    cr: A numpy array of the cumulative return of each portfolio
+    adr: A numpy array of the average daily return of each portfolio
+    sddr: A numpy array of the standard deviation of daily return of each 
+    portfolio
+    sr: A numpy array of the Sharpe ratio of each portfolio
+    """
+    cr = port_vals[:, -1] / port_vals[:, 0] - 1
+
+    daily_returns = port_vals[:, 1:] / port_vals[:, :-1] - 1
+    adr = daily_returns.mean(axis=1)
+    sddr = daily_returns.std(axis=1, ddof=1)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        sr = compute_sharpe_ratio(np.sqrt(samples_per_year), adr, daily_rf, sddr)
+
+    return cr, adr, sddr, sr
+
+
 def plot_normalized_data(df, title, xlabel, ylabel, save_fig=False, 
                          fig_name="plot.png"):
     """Helper function to normalize and plot data."""
@@ -5,14 +5,15 @@ a csv file.
 import pandas as pd
 import numpy as np
 import datetime as dt
+from itertools import islice
 import matplotlib.pyplot as plt
 from analysis import get_portfolio_value, get_portfolio_stats, \
-plot_normalized_data
-from util import get_data, normalize_data
+get_portfolio_stats_batch, plot_normalized_data
+from util import normalize_data, load_prices
 
 
 def compute_portvals_single_symbol(df_orders, symbol, start_val=1000000, 
-    commission=9.95, impact=0.005):
+    commission=9.95, impact=0.005, prices=None):
     """Compute portfolio values for a single symbol.
 
     Parameters:
@@ -23,72 +24,51 @@ def compute_portvals_single_symbol(df_orders, symbol, start_val=1000000,
     commission: The fixed amount in dollars charged for each transaction
     impact: The amount the price moves against the trader compared to the 
     historical data at each transaction
+    prices: A PriceProvider or a dataframe of adjusted close prices with a 
+    column for symbol, as returned by get_data, covering the dates of 
+    df_orders. If None, prices are read from disk
     
     Returns:
     portvals: A dataframe with one column containing the value of the portfolio
     for each trading day
     """
 
-    # Sort the orders dataframe by date
-    df_orders.sort_index(ascending=True, inplace=True)
-    
     # Get the start and end dates
     start_date = df_orders.index.min()
     end_date = df_orders.index.max()
 
     # Create a dataframe with adjusted close prices for the symbol and for cash
-    df_prices = get_data([symbol], pd.date_range(start_date, end_date))
+    df_prices = load_prices([symbol], pd.date_range(start_date, end_date), 
+                            prices=prices)
 
     if df_prices.shape[1] > 1:
         del df_prices["SPY"]
     df_prices["cash"] = 1.0
 
     # Fill NAN values if any
-    df_prices.fillna(method="ffill", inplace=True)
-    df_prices.fillna(method="bfill", inplace=True)
-    df_prices.fillna(1.0, inplace=True)
+    df_prices = df_prices.ffill().bfill().fillna(1.0)
+
+    # Changes in the number of shares and cash of each order. The cash paid for
+    # a BUY (Shares > 0) or received for a SELL (Shares < 0) is the traded 
+    # share value, less the transaction cost of each non-zero order
+    shares = df_orders["Shares"].values.astype(float)
+    order_prices = df_prices.loc[df_orders.index, symbol].values
+    transaction_costs = np.where(shares != 0, 
+        commission + impact * order_prices * np.abs(shares), 0.0)
+    df_order_trades = pd.DataFrame({symbol: shares, 
+        "cash": -(order_prices * shares) - transaction_costs}, 
+        index=df_orders.index)
 
     # Create a dataframe that represents changes in the number of shares by day
-    df_trades = pd.DataFrame(np.zeros((df_prices.shape)), df_prices.index, 
-        df_prices.columns)
-    for index, row in df_orders.iterrows():
-        # Total value of shares purchased or sold
-        traded_share_value = df_prices.loc[index, symbol] * row["Shares"]
-        # Transaction cost 
-        transaction_cost = commission + impact * df_prices.loc[index, symbol] \
-                            * abs(row["Shares"])
-
-        # Update the number of shares and cash based on the type of transaction
-        # Note: The same asset may be traded more than once on a particular day
-        # If the shares were bought
-        if row["Shares"] > 0:
-            df_trades.loc[index, symbol] = df_trades.loc[index, symbol] \
-                                            + row["Shares"]
-            df_trades.loc[index, "cash"] = df_trades.loc[index, "cash"] \
-                                            - traded_share_value \
-                                            - transaction_cost
-        # If the shares were sold
-        elif row["Shares"] < 0:
-            df_trades.loc[index, symbol] = df_trades.loc[index, symbol] \
-                                            + row["Shares"]
-            df_trades.loc[index, "cash"] = df_trades.loc[index, "cash"] \
-                                            - traded_share_value \
-                                            - transaction_cost
+    # Note: The same asset may be traded more than once on a particular day
+    df_trades = df_order_trades.groupby(level=0, sort=True).sum()
+    df_trades = df_trades.reindex(df_prices.index, fill_value=0.0)
+    df_trades = df_trades[df_prices.columns]
+
     # Create a dataframe that represents on each particular day how much of
-    # each asset in the portfolio
-    df_holdings = pd.DataFrame(np.zeros((df_prices.shape)), df_prices.index, 
-        df_prices.columns)
-    for row_count in range(len(df_holdings)):
-        # In the first row, the number shares are the same as in df_trades, 
-        # but start_val must be added to cash
-        if row_count == 0:
-            df_holdings.iloc[0, :-1] = df_trades.iloc[0, :-1].copy()
-            df_holdings.iloc[0, -1] = df_trades.iloc[0, -1] + start_val
-        # The rest of the rows show cumulative values
-        else:
-            df_holdings.iloc[row_count] = df_holdings.iloc[row_count-1] \
-                                            + df_trades.iloc[row_count]
-        row_count += 1
+    # each asset in the portfolio. start_val is added to cash on the first day
+    df_trades.iloc[0, -1] += start_val
+    df_holdings = df_trades.cumsum()
 
     # Create a dataframe that represents the monetary value of each asset 
     df_value = df_prices * df_holdings
@@ -97,9 +77,194 @@ def compute_portvals_single_symbol(df_orders, symbol, start_val=1000000,
     portvals = pd.DataFrame(df_value.sum(axis=1), df_value.index, ["port_val"])
     return portvals
 
+def compute_portvals(df_orders, start_val=1000000, commission=9.95, 
+    impact=0.005, prices=None):
+    """Compute portfolio values for orders across any number of symbols.
+
+    Parameters:
+    df_orders: A dataframe of orders indexed by date with a "Symbol" column, a
+    "Shares" column and an "Order" column of "BUY" or "SELL". Without an 
+    "Order" column, Shares > 0 buys and Shares < 0 sells
+    start_val: The starting value of the portfolio (initial cash available)
+    commission: The fixed amount in dollars charged for each transaction
+    impact: The amount the price moves against the trader compared to the 
+    historical data at each transaction
+    prices: A PriceProvider or a dataframe of adjusted close prices with a 
+    column for each symbol, as returned by get_data, covering the dates of 
+    df_orders. If None, prices are read from disk
+    
+    Returns:
+    portvals: A dataframe with one column containing the value of the portfolio
+    for each trading day
+    """
+    # Get the start and end dates and the symbols traded
+    start_date = df_orders.index.min()
+    end_date = df_orders.index.max()
+    symbols = sorted(df_orders["Symbol"].unique())
+
+    # Create a dataframe with adjusted close prices for all the symbols, one 
+    # column per symbol aligned on the trading days
+    dates = pd.date_range(start_date, end_date)
+    df_prices = load_prices(symbols, dates, prices=prices)[symbols]
+
+    # Fill NAN values if any
+    df_prices = df_prices.ffill().bfill().fillna(1.0)
+    price_matrix = df_prices.values
+
+    # Locate each order in the price matrix
+    days = df_prices.index.get_indexer(df_orders.index)
+    if (days < 0).any():
+        raise KeyError("Orders on dates without prices: {}".format(
+            list(df_orders.index[days < 0])))
+    columns = pd.Index(symbols).get_indexer(df_orders["Symbol"])
+    shares = df_orders["Shares"].values.astype(float)
+    if "Order" in df_orders:
+        shares = np.where(df_orders["Order"].str.upper() == "SELL", 
+                          -np.abs(shares), np.abs(shares))
+
+    # Changes in the number of shares of each symbol and in cash by day. The 
+    # cash paid for a BUY or received for a SELL is the traded share value, 
+    # less the transaction cost of each non-zero order
+    order_prices = price_matrix[days, columns]
+    transaction_costs = np.where(shares != 0, 
+        commission + impact * order_prices * np.abs(shares), 0.0)
+    trades = np.zeros(price_matrix.shape)
+    np.add.at(trades, (days, columns), shares)
+    cash_trades = np.zeros(price_matrix.shape[0])
+    np.add.at(cash_trades, days, -(order_prices * shares) - transaction_costs)
+
+    # Holdings of each symbol and cash on each day, and the value of the 
+    # portfolio
+    holdings = np.cumsum(trades, axis=0)
+    cash = start_val + np.cumsum(cash_trades)
+    port_val = (holdings * price_matrix).sum(axis=1) + cash
+    portvals = pd.DataFrame(port_val, df_prices.index, ["port_val"])
+    return portvals
+
+def compute_portvals_batch(orders, prices, start_val=1000000, commission=9.95,
+    impact=0.005, positions=False, daily_rf=0.0, samples_per_year=252.0):
+    """Compute portfolio values and statistics for many candidate order series
+    of a single symbol against one price path at once.
+
+    Unlike compute_portvals_single_symbol(), every portfolio is valued over 
+    the whole price path rather than from its first to its last trade.
+
+    Parameters:
+    orders: A 2-d numpy array with the number of shares each candidate (first
+    dimension) buys (> 0) or sells (< 0) on each day (second dimension)
+    prices: A numpy array of the adjusted close price on each day
+    start_val: The starting value of each portfolio (initial cash available)
+    commission: The fixed amount in dollars charged for each transaction
+    impact: The amount the price moves against the trader compared to the 
+    historical data at each transaction
+    positions: If True, orders holds the number of shares held at the end of 
+    each day instead, and the trades are the changes in it
+    daily_rf: Daily risk-free rate, assuming it does not change
+    samples_per_year: Sampling frequency per year
+
+    Returns:
+    portvals: A 2-d numpy array with the value of each portfolio on each day
+    stats: The cumulative return, average daily return, standard deviation 
+    of daily return and Sharpe ratio of each portfolio, as numpy arrays. See 
+    get_portfolio_stats_batch()
+    """
+    trades = np.atleast_2d(np.asarray(orders, dtype=float))
+    prices = np.asarray(prices, dtype=float)
+    if positions:
+        trades = np.diff(trades, axis=1, prepend=0.0)
+
+    # Cash paid for shares bought or received for shares sold, plus the 
+    # transaction cost of each trade
+    transaction_costs = (trades != 0) * (commission 
+                                         + impact * prices * np.abs(trades))
+    cash = start_val - np.cumsum(trades * prices + transaction_costs, axis=1)
+    holdings = np.cumsum(trades, axis=1)
+    portvals = cash + holdings * prices
+    return portvals, get_portfolio_stats_batch(portvals, daily_rf=daily_rf,
+        samples_per_year=samples_per_year)
+
+def stream_portvals(bars, orders, start_val=1000000, commission=9.95, 
+    impact=0.005):
+    """Compute portfolio values for a single symbol one bar at a time.
+
+    Unlike compute_portvals_single_symbol(), nothing is loaded up front: bars
+    and orders are consumed as they are yielded and only the current cash and
+    holdings are kept, so memory does not grow with the length of the history
+    and bars can be of any frequency, e.g. minute bars. A missing (NaN) price 
+    is replaced by the last valid one, and bars before the first valid price 
+    are skipped.
+
+    Parameters:
+    bars: An iterable of (timestamp, price) pairs sorted by timestamp, e.g. 
+    util.iter_price_bars() of a symbol converted with util.convert_to_store()
+    orders: An iterable of (timestamp, shares) pairs sorted by timestamp, 
+    where shares > 0 buys and shares < 0 sells, e.g. df_orders["Shares"].items()
+    An order is executed at the price of the first bar at or after its 
+    timestamp; orders after the last bar are not executed
+    start_val: The starting value of the portfolio (initial cash available)
+    commission: The fixed amount in dollars charged for each transaction
+    impact: The amount the price moves against the trader compared to the 
+    historical data at each transaction
+
+    Yields:
+    timestamp, port_val: The timestamp of each bar and the value of the 
+    portfolio at its price, after executing the orders up to it
+
+    Raises:
+    ValueError: If the timestamps of bars or of orders decrease
+    """
+    cash = float(start_val)
+    holdings = 0.0
+    price = np.nan
+    orders = iter(orders)
+    order = next(orders, None)
+    last_timestamp = None
+    for timestamp, bar_price in bars:
+        if last_timestamp is not None and timestamp < last_timestamp:
+            raise ValueError("Bars are not sorted by timestamp: {} after {}"
+                             .format(timestamp, last_timestamp))
+        last_timestamp = timestamp
+        if not np.isnan(bar_price):
+            price = bar_price
+        if np.isnan(price):
+            continue
+        # Execute the orders up to this bar at its price
+        while order is not None and order[0] <= timestamp:
+            shares = order[1]
+            if shares != 0:
+                holdings += shares
+                cash -= price * shares + commission + impact * price * abs(shares)
+            next_order = next(orders, None)
+            if next_order is not None and next_order[0] < order[0]:
+                raise ValueError("Orders are not sorted by timestamp: {} after {}"
+                                 .format(next_order[0], order[0]))
+            order = next_order
+        yield timestamp, cash + holdings * price
+
+def write_portvals(portvals, path, chunk_size=100000):
+    """Write a stream of portfolio values, e.g. from stream_portvals(), to a 
+    CSV file with a Date and a port_val column, chunk_size rows at a time.
+
+    Returns:
+    num_rows: The number of rows written
+    """
+    num_rows = 0
+    header = True
+    with open(path, "w") as f:
+        while True:
+            chunk = list(islice(portvals, chunk_size))
+            if not chunk:
+                break
+            timestamps, values = zip(*chunk)
+            pd.DataFrame({"port_val": values}, 
+                index=pd.Index(timestamps, name="Date")).to_csv(f, header=header)
+            header = False
+            num_rows += len(chunk)
+    return num_rows
+
 def market_simulator(df_orders, df_orders_benchmark, symbol, start_val=1000000,
     commission=9.95, impact=0.005, daily_rf=0.0, samples_per_year=252.0, 
-    save_fig=False, fig_name="plot.png"):
+    save_fig=False, fig_name="plot.png", prices=None):
     """
     This function takes in and executes trades from orders dataframes
 
@@ -114,6 +279,8 @@ def market_simulator(df_orders, df_orders_benchmark, symbol, start_val=1000000,
     samples_per_year: Sampling frequency per year
     save_fig: Whether to save the plot or not
     fig_name: The name of the saved figure
+    prices: A PriceProvider or a dataframe of already loaded prices, see 
+    compute_portvals_single_symbol(). If None, prices are read from disk
 
     Returns:
     Print out final portfolio value of the portfolio, Sharpe ratio, cumulative
@@ -122,7 +289,8 @@ def market_simulator(df_orders, df_orders_benchmark, symbol, start_val=1000000,
     """    
     # Process portfolio orders
     portvals = compute_portvals_single_symbol(df_orders=df_orders, symbol=symbol,
-        start_val=start_val, commission=commission, impact=impact)
+        start_val=start_val, commission=commission, impact=impact, 
+        prices=prices)
 
     # Get portfolio stats
     cum_ret, avg_daily_ret, std_daily_ret, sharpe_ratio = get_portfolio_stats(
@@ -130,7 +298,8 @@ def market_simulator(df_orders, df_orders_benchmark, symbol, start_val=1000000,
     
     # Process benchmark orders
     portvals_bm = compute_portvals_single_symbol(df_orders=df_orders_benchmark, 
-        symbol=symbol, start_val=start_val, commission=commission, impact=impact)
+        symbol=symbol, start_val=start_val, commission=commission, impact=impact,
+        prices=prices)
     
     # Get benchmark stats
     cum_ret_bm, avg_daily_ret_bm, std_daily_ret_bm, sharpe_ratio_bm = \
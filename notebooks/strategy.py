@@ -1,16 +1,19 @@
 """Implement a strategy using Q-Learning, or eventually a DQN"""
 import numpy as np
 import datetime as dt
+import math
+from bisect import bisect_left
+from collections import deque
 import pandas as pd
 import matplotlib.pyplot as plt
 import seaborn as sns
 from IPython.display import clear_output
 
-from util import get_data, create_df_benchmark, create_df_trades
+from util import create_df_benchmark, create_df_trades, \
+save_bundle, load_bundle, load_prices
 import QLearner as ql
 from indicators import get_momentum, get_sma_indicator, compute_bollinger_value
-from marketsim import compute_portvals_single_symbol, market_simulator
-from analysis import get_portfolio_stats
+from marketsim import market_simulator
 
 class StrategyLearner(object):
     # Constants for positions and order signals
@@ -43,6 +46,12 @@ class StrategyLearner(object):
         self.verbose = verbose
         self.window_size = 10
         self.q_learner = learner
+        # The thresholds used to discretize features and the cumulative return
+        # of each training epoch, set by add_evidence
+        self.thresholds = None
+        self.cum_returns = []
+        # The latest prices fed to step(), set by reset_stream
+        self.stream_prices = None
         # Initialize a QLearner
         # self.q_learner = ql.QLearner(**kwargs)
 
@@ -87,18 +96,22 @@ class StrategyLearner(object):
         indices of features in df_features and the second dimension refers to 
         the value of a feature at a particular threshold.
         """
-        
-        step_size = round(df_features.shape[0] / num_steps)
-        df_copy = df_features.copy()
-        thres = np.zeros(shape=(df_features.shape[1], num_steps))
-        for i, feat in enumerate(df_features.columns):
-            df_copy.sort_values(by=[feat], inplace=True)
-            for step in range(num_steps):
-                if step < num_steps - 1:
-                    thres[i, step] = df_copy[feat].iloc[(step + 1) * step_size]
-                # The last threshold must be = the largest value in df_copy
-                else:
-                    thres[i, step] = df_copy[feat].iloc[-1]
+
+        # Sort every feature at once; the thresholds are evenly spaced 
+        # quantiles of each feature
+        return self.get_thresholds_from_sorted(
+            np.sort(np.asarray(df_features, dtype=float), axis=0), num_steps)
+
+    def get_thresholds_from_sorted(self, sorted_features, num_steps):
+        """
+        Compute the thresholds like get_thresholds() from a 2-d numpy array of 
+        features in which each column has been sorted in ascending order.
+        """
+        step_size = round(sorted_features.shape[0] / num_steps)
+        thres = np.zeros(shape=(sorted_features.shape[1], num_steps))
+        thres[:, :-1] = sorted_features[np.arange(1, num_steps) * step_size].T
+        # The last threshold must be = the largest value of each feature
+        thres[:, -1] = sorted_features[-1]
         return thres
 
     def discretize(self, df_features, non_neg_position, thresholds):
@@ -116,11 +129,32 @@ class StrategyLearner(object):
         It indicates an index of the first dimension in the Q-table
         """
         state = non_neg_position * pow(self.num_steps, len(df_features))
-        for i in range(len(df_features)):
-            thres = thresholds[i][thresholds[i] >= df_features[i]][0]
-            thres_i = np.where(thresholds == thres)[1][0]
-            state += thres_i * pow(self.num_steps, i)
-        return state
+        state += self.encode_features(np.atleast_2d(df_features), 
+                                      thresholds)[0]
+        return int(state)
+
+    def encode_features(self, df_features, thresholds):
+        """
+        Discretize the features of every day at once. The bin of a feature is 
+        the index of the first threshold that is >= its value; values above the 
+        last threshold fall into the last bin.
+
+        Parameters:
+        df_features: A dataframe or 2-d numpy array of technical indicators 
+        with days as rows and features as columns
+        thresholds: The thresholds computed in get_thresholds()
+
+        Returns:
+        feature_states: A numpy array with the state of each day for a 
+        position of 0. The state for position p is 
+        feature_states + p * pow(self.num_steps, number of features)
+        """
+        values = np.asarray(df_features, dtype=float)
+        bins = np.empty(shape=values.shape, dtype=np.int64)
+        for i in range(values.shape[1]):
+            bins[:, i] = np.searchsorted(thresholds[i], values[:, i])
+        bins = np.minimum(bins, self.num_steps - 1)
+        return bins @ pow(self.num_steps, np.arange(values.shape[1]))
 
     def get_position(self, old_pos, signal):
         """Find a new position based on the old position and the given signal.
@@ -128,15 +162,30 @@ class StrategyLearner(object):
         computed in discretize(), in the Q-table. An action is 0, 1 or 2. It is
         an index of the second dimension in the Q-table. We have to subtract 1
         from action to get a signal of -1, 0 or 1 (short, cash or long).
+        old_pos and signal can also be numpy arrays, e.g. one per agent.
         """
-        new_pos = self.CASH
         # If old_pos is not long and signal is to buy, new_pos will be long
-        if old_pos < self.LONG and signal == self.LONG:
-            new_pos = self.LONG
+        buy = (old_pos < self.LONG) & (signal == self.LONG)
         # If old_pos is not short and signal is to sell, new_pos will be short
-        elif old_pos > self.SHORT and signal == self.SHORT:
-            new_pos = self.SHORT
-        return new_pos
+        sell = (old_pos > self.SHORT) & (signal == self.SHORT)
+        # Otherwise new_pos is cash
+        return self.LONG * buy + self.SHORT * sell
+
+    def execute_trade(self, new_pos, price, cash, shares):
+        """Buy (new_pos > 0) or sell (new_pos < 0) num_shares at price, paying
+        commission and impact if there is a trade. new_pos, cash and shares 
+        can also be numpy arrays, e.g. one per agent.
+
+        Returns:
+        cash: The cash after the trade
+        shares: The number of shares held after the trade
+        """
+        traded = new_pos != self.CASH
+        cash = cash - (new_pos * self.num_shares * price 
+                       + traded * (self.commission 
+                                   + self.impact * price * self.num_shares))
+        shares = shares + new_pos * self.num_shares
+        return cash, shares
 
     def get_daily_reward(self, prev_price, curr_price, position):
         """Calculate the daily reward as a percentage change in prices: 
@@ -176,7 +225,7 @@ class StrategyLearner(object):
         return True
 
     def add_evidence(self, symbol="IBM", start_date=dt.datetime(2008,1,1),
-        end_date=dt.datetime(2009,12,31), start_val = 10000):
+        end_date=dt.datetime(2009,12,31), start_val = 10000, prices=None):
         """Create a QLearner, and train it for trading.
 
         Parameters:
@@ -184,58 +233,46 @@ class StrategyLearner(object):
         start_date: A datetime object that represents the start date
         end_date: A datetime object that represents the end date
         start_val: Start value of the portfolio which contains only the symbol
+        prices: A PriceProvider or a dataframe of adjusted close prices with a 
+        column for symbol, as returned by get_data, covering start_date to 
+        end_date. If None, prices are read from disk
         """
         dates = pd.date_range(start_date, end_date)
         # Get adjusted close prices for symbol
-        df_prices = get_data([symbol], dates)
+        df_prices = load_prices([symbol], dates, prices=prices)
         # Get features and thresholds
         df_features = self.get_features(df_prices[symbol])
         thresholds = self.get_thresholds(df_features, self.num_steps)
-        cum_returns = []
-        for epoch in range(1, self.epochs + 1):
-            # Initial position is holding nothing
-            position = self.CASH
-            # Create a series that captures order signals based on actions taken
-            orders = pd.Series(index=df_features.index)
-            # Iterate over the data by date
+        self.train(df_features, df_prices[symbol], thresholds, start_val)
 
-            for day, date in enumerate(df_features.index):
-                # Get a state; add 1 to position so that states >= 0
-                state = self.discretize(df_features.loc[date], 
-                                        position + 1, thresholds)
-                # On the first day, get an action without updating the Q-table
-                if date == df_features.index[0]:
-                    # Get the first action based on nothing
-                    # action = self.q_learner.act(state)
-                    action = self.q_learner.act(state, 0.0, update=False)
-
-                # On other days, calculate the reward and update the Q-table
-                else:
-                    prev_price = df_prices[symbol].iloc[day-1]
-                    curr_price = df_prices[symbol].loc[date]
-                    reward = self.get_daily_reward(prev_price, 
-                                                   curr_price, position)
-                    action = self.q_learner.act(state, reward, update=True, done=date==df_features.index[-1])
-                # On the last day, close any open positions
-                if date == df_features.index[-1]:
-                    new_pos = -position
-                else:
-                    new_pos = self.get_position(position, action - 1)
+    def train(self, df_features, prices, thresholds, start_val=10000):
+        """Train the QLearner on features that have already been computed. The 
+        Q-table is not reset, so this continues the training of a learner.
 
-                # Add new_pos to orders
-                orders.loc[date] = new_pos
-                # Update current position
-                position += new_pos
-            
+        Parameters:
+        df_features: The technical indicators computed in get_features()
+        prices: A series of adjusted close prices of the symbol, starting at 
+        the first price df_features was computed from
+        thresholds: The thresholds computed in get_thresholds(), which are kept 
+        in self.thresholds
+        start_val: Start value of the portfolio which contains only the symbol
+        """
+        self.thresholds = thresholds
+        # The part of the state that depends on the features; the position adds
+        # a multiple of position_step to it
+        feature_states = self.encode_features(df_features, thresholds)
+        position_step = pow(self.num_steps, df_features.shape[1])
+        # Prices of each day in df_features, and the prices the rewards are 
+        # computed against: as before, the price day - 1 rows into prices
+        curr_prices = prices.loc[df_features.index].values
+        prev_prices = prices.values[:df_features.shape[0] - 1]
+        cum_returns = []
+        for epoch in range(1, self.epochs + 1):
+            # Step through the data, keeping track of the portfolio value
+            orders, cum_return = self.run_episode(feature_states, 
+                position_step, prev_prices, curr_prices, start_val=start_val)
             self.q_learner.replay(batch_size=32)
 
-            df_trades = create_df_trades(orders, symbol, self.num_shares)
-            portvals = compute_portvals_single_symbol(df_orders=df_trades, 
-                                                      symbol=symbol, 
-                                                      start_val=start_val, 
-                                                      commission=self.commission,
-                                                      impact=self.impact)
-            cum_return = get_portfolio_stats(portvals)[0]
             cum_returns.append(cum_return)
             if self.verbose: 
                 print (epoch, cum_return)
@@ -244,22 +281,201 @@ class StrategyLearner(object):
                 # Stop if the cum_return doesn't improve for 10 epochs
                 if self.has_converged(cum_returns):
                     break
+        # Keep the cumulative return of each epoch for reporting
+        self.cum_returns = cum_returns
         if self.verbose:
-            sns.heatmap(self.q_learner.Q, cmap='Blues')
+            sns.heatmap(np.asarray(self.q_learner.Q), cmap='Blues')
             plt.plot(cum_returns)
             plt.xlabel("Epoch")
             plt.ylabel("Cumulative return (%)")
             plt.show()
 
+    def run_episode(self, feature_states, position_step, prev_prices=None, 
+                    curr_prices=None, start_val=10000, update=True):
+        """Step the QLearner through the days of one episode, starting and 
+        ending with no position. If prices are given, cash and holdings are 
+        updated with each trade, including commission and impact, to get the 
+        cumulative return the market simulator would compute for the episode's 
+        trades, i.e. from the value after the first trade to the value after 
+        the last one.
+
+        Parameters:
+        feature_states: A numpy array of the state of each day for a position 
+        of 0, computed in encode_features()
+        position_step: The amount the state grows by for each unit of position
+        prev_prices: A numpy array of the price each day's reward is computed 
+        against, starting from the second day. Only used if update is True
+        curr_prices: A numpy array of the price of each day. Required if update
+        is True
+        start_val: Start value of the portfolio which contains only the symbol
+        update: If True, update the Q-table with the daily rewards
+
+        Returns:
+        orders: A numpy array of the order signal (-1, 0 or 1) of each day
+        cum_return: The cumulative return of the episode; 0.0 if there were no 
+        trades and NaN if curr_prices is None
+        """
+        num_days = len(feature_states)
+        orders = np.zeros(num_days)
+        # Initial position is holding nothing
+        position = self.CASH
+        cash = start_val
+        shares = 0
+        # Portfolio value after the first and the latest trades
+        first_val = last_val = None
+        for day in range(num_days):
+            # Get a state; add 1 to position so that states >= 0
+            state = int(feature_states[day] + (position + 1) * position_step)
+            # On the first day, get an action without updating the Q-table
+            if day == 0 or not update:
+                action = self.q_learner.act(state, 0.0, update=False)
+            # On other days, calculate the reward and update the Q-table
+            else:
+                reward = self.get_daily_reward(prev_prices[day - 1], 
+                                               curr_prices[day], position)
+                action = self.q_learner.act(state, reward, update=True, 
+                                            done=day == num_days - 1)
+            # On the last day, close any open positions
+            if day == num_days - 1:
+                new_pos = -position
+            else:
+                new_pos = self.get_position(position, action - 1)
+            orders[day] = new_pos
+            # Execute the trade
+            if new_pos != self.CASH and curr_prices is not None:
+                price = curr_prices[day]
+                cash, shares = self.execute_trade(new_pos, price, cash, shares)
+                last_val = cash + shares * price
+                if first_val is None:
+                    first_val = last_val
+            # Update current position
+            position += new_pos
+        if curr_prices is None:
+            return orders, np.nan
+        if first_val is None:
+            return orders, 0.0
+        return orders, last_val / first_val - 1
+
+    def save(self, path):
+        """Save the trained policy, i.e. the parameters of the strategy, the 
+        thresholds and the QLearner, to a single file at path.
+        """
+        if self.thresholds is None:
+            raise ValueError("There is no trained policy to save; call "
+                             "add_evidence() before save()")
+        arrays, learner_header = self.q_learner.get_bundle()
+        arrays = {"q_learner." + name: array for name, array in arrays.items()}
+        arrays["thresholds"] = self.thresholds
+        header = {"num_shares": self.num_shares, "epochs": self.epochs,
+                  "num_steps": self.num_steps, "impact": self.impact,
+                  "commission": self.commission, 
+                  "window_size": self.window_size, "q_learner": learner_header}
+        save_bundle(path, arrays, header)
+
+    @classmethod
+    def load(cls, path, mmap=True):
+        """Load a policy saved with save(). If mmap is True, the Q table is 
+        memory-mapped read-only so that processes loading the same file share 
+        it; the policy can then be tested but not trained further.
+        """
+        arrays, header = load_bundle(path, mmap_names=["q_learner.Q", 
+            "q_learner.Q.values"] if mmap else [])
+        learner = ql.QLearner.from_bundle(
+            {name[len("q_learner."):]: array for name, array in arrays.items() 
+             if name.startswith("q_learner.")}, header.pop("q_learner"))
+        window_size = header.pop("window_size")
+        strategy = cls(learner=learner, **header)
+        strategy.window_size = window_size
+        strategy.thresholds = arrays["thresholds"]
+        return strategy
+
+    def add_evidence_batch(self, learner, symbol="IBM", 
+        start_date=dt.datetime(2008,1,1), end_date=dt.datetime(2009,12,31), 
+        start_val=10000, prices=None):
+        """Train the agents of a BatchQLearner in lockstep over the same data.
+        Each agent keeps its own position, so agents see different states. 
+        Training runs for self.epochs epochs without checking for convergence.
+        The thresholds are kept in self.thresholds, as in train().
+
+        Parameters:
+        learner: A BatchQLearner whose num_states fits the discretized states
+        symbol: The stock symbol to act on
+        start_date: A datetime object that represents the start date
+        end_date: A datetime object that represents the end date
+        start_val: Start value of the portfolio which contains only the symbol
+        prices: A PriceProvider or a dataframe of already loaded prices, see 
+        add_evidence(). If None, prices are read from disk
+
+        Returns:
+        cum_returns: A 2-d numpy array with the cumulative return of each agent 
+        (second dimension) in each epoch (first dimension)
+        """
+        dates = pd.date_range(start_date, end_date)
+        # Get adjusted close prices for symbol
+        df_prices = load_prices([symbol], dates, prices=prices)
+        # Get features and thresholds
+        df_features = self.get_features(df_prices[symbol])
+        thresholds = self.get_thresholds(df_features, self.num_steps)
+        self.thresholds = thresholds
+        # The part of the state that depends on the features; the position adds
+        # a multiple of position_step to it
+        feature_states = self.encode_features(df_features, thresholds)
+        position_step = pow(self.num_steps, df_features.shape[1])
+        curr_prices = df_prices[symbol].loc[df_features.index].values
+        prev_prices = df_prices[symbol].values
+        last_day = df_features.shape[0] - 1
+        cum_returns = np.zeros(shape=(self.epochs, learner.n_agents))
+        for epoch in range(self.epochs):
+            # Initial position of every agent is holding nothing
+            position = np.full(learner.n_agents, self.CASH)
+            # Keep track of cash and shares held by each agent and of the value
+            # of its portfolio on the days of its first and latest trades
+            cash = np.full(learner.n_agents, float(start_val))
+            shares = np.zeros(learner.n_agents)
+            first_val = np.full(learner.n_agents, np.nan)
+            last_val = np.full(learner.n_agents, np.nan)
+            for day in range(last_day + 1):
+                # Get a state; add 1 to position so that states >= 0
+                state = feature_states[day] + (position + 1) * position_step
+                if day == 0:
+                    action = learner.act(state, 0.0, update=False)
+                else:
+                    reward = self.get_daily_reward(prev_prices[day - 1], 
+                        curr_prices[day], position)
+                    action = learner.act(state, reward, update=True, 
+                                         done=day == last_day)
+                # On the last day, close any open positions
+                if day == last_day:
+                    new_pos = -position
+                else:
+                    new_pos = self.get_position(position, action - 1)
+                # Execute the trades
+                price = curr_prices[day]
+                traded = new_pos != self.CASH
+                cash, shares = self.execute_trade(new_pos, price, cash, shares)
+                last_val = np.where(traded, cash + shares * price, last_val)
+                first_val = np.where(traded & np.isnan(first_val), last_val, 
+                                     first_val)
+                # Update current position
+                position += new_pos
+            cum_returns[epoch] = np.nan_to_num(last_val / first_val - 1)
+            if self.verbose:
+                print (epoch + 1, cum_returns[epoch].max())
+        return cum_returns
+
     def test_policy(self, symbol="IBM", start_date=dt.datetime(2010,1,1),
-        end_date=dt.datetime(2011,12,31), start_val=10000):
-        """Use the existing policy and test it against new data.
+        end_date=dt.datetime(2011,12,31), start_val=10000, prices=None):
+        """Use the existing policy and test it against new data. Features are
+        discretized with the thresholds computed from the training data.
 
         Parameters:
         symbol: The stock symbol to act on
         start_date: A datetime object that represents the start date
         end_date: A datetime object that represents the end date
         start_val: Start value of the portfolio which contains only the symbol
+        prices: A PriceProvider or a dataframe of adjusted close prices with a 
+        column for symbol, as returned by get_data, covering start_date to 
+        end_date. If None, prices are read from disk
         
         Returns:
         df_trades: A dataframe whose values represent trades for each day: 
@@ -269,29 +485,94 @@ class StrategyLearner(object):
 
         dates = pd.date_range(start_date, end_date)
         # Get adjusted close pricess for symbol
-        df_prices = get_data([symbol], dates)
-        # Get features and thresholds
+        df_prices = load_prices([symbol], dates, prices=prices)
+        # Get features and use the thresholds of the training data, or those of
+        # this data if the learner has not been trained
         df_features = self.get_features(df_prices[symbol])
-        thresholds = self.get_thresholds(df_features, self.num_steps)
-        # Initial position is holding nothing
-        position = self.CASH
-        # Create a series that captures order signals based on actions taken
-        orders = pd.Series(index=df_features.index)
-        # Iterate over the data by date
-        for date in df_features.index:
-            # Get a state; add 1 to position so that states >= 0
-            state = self.discretize(df_features.loc[date], 
-                                    position + 1, thresholds)
-            action = self.q_learner.act(state, 0.0, update=False)
-            # On the last day, close any open positions
-            if date == df_features.index[-1]:
-                new_pos = -position
-            else:
-                new_pos = self.get_position(position, action - 1)
-            # Add new_pos to orders
-            orders.loc[date] = new_pos
-            # Update current position
-            position += new_pos
+        thresholds = self.thresholds
+        if thresholds is None:
+            thresholds = self.get_thresholds(df_features, self.num_steps)
+        return self.get_trades(df_features, thresholds, symbol)
+
+    def get_trades(self, df_features, thresholds, symbol):
+        """Use the existing policy on features that have already been computed.
+
+        Parameters:
+        df_features: The technical indicators computed in get_features()
+        thresholds: The thresholds used to discretize df_features
+        symbol: The stock symbol to act on
+
+        Returns:
+        df_trades: A dataframe of trades as returned by test_policy()
+        """
+        feature_states = self.encode_features(df_features, thresholds)
+        position_step = pow(self.num_steps, df_features.shape[1])
+        # Step through the data and capture order signals based on actions
+        orders = self.run_episode(feature_states, position_step, 
+                                  update=False)[0]
+        orders = pd.Series(orders, index=df_features.index)
         # Create a trade dataframe
         df_trades = create_df_trades(orders, symbol, self.num_shares)
         return df_trades
+
+    def reset_stream(self):
+        """Start a new stream of prices for step() with no position. Requires 
+        thresholds from add_evidence() or load().
+        """
+        if self.thresholds is None:
+            raise ValueError("There is no trained policy to stream; call "
+                             "add_evidence() or load() before reset_stream()")
+        # The latest window_size + 1 prices, enough for momentum
+        self.stream_prices = deque(maxlen=self.window_size + 1)
+        self.stream_position = self.CASH
+        self.stream_thresholds = [list(thres) for thres in self.thresholds]
+        # The amount the state grows by for each bin of each feature and for 
+        # each unit of position
+        self.stream_steps = [pow(self.num_steps, i) 
+                             for i in range(len(self.thresholds) + 1)]
+
+    def step(self, price):
+        """Feed the next adjusted close price of the symbol and get the order 
+        to execute at that price, using the existing policy greedily. The 
+        features of get_features() are updated from the latest prices without
+        pandas; no order is placed until there are enough prices to compute 
+        them, nor when the latest prices are all equal. Call reset_stream() 
+        before the first price.
+
+        Parameters:
+        price: The latest adjusted close price
+
+        Returns:
+        order: The number of shares to buy (> 0) or sell (< 0), or 0
+        """
+        if self.stream_prices is None:
+            raise ValueError("No stream has been started; call reset_stream() "
+                             "before step()")
+        prices = self.stream_prices
+        prices.append(price)
+        if len(prices) <= self.window_size:
+            return 0
+
+        # Rolling mean and std of the latest window_size prices
+        window = list(prices)[1:]
+        mean = sum(window) / self.window_size
+        std = math.sqrt(sum((p - mean) ** 2 for p in window) 
+                        / (self.window_size - 1))
+        # Like the NaN features get_features() drops, a flat window gives no 
+        # Bollinger value, so no order is placed and the position is kept
+        if std == 0:
+            return 0
+        features = (price / prices[0] - 1, price / mean - 1, 
+                    (price - mean) / std)
+
+        # Discretize the features; add 1 to position so that states >= 0
+        state = (self.stream_position + 1) * self.stream_steps[-1]
+        for i, value in enumerate(features):
+            thres_i = min(bisect_left(self.stream_thresholds[i], value), 
+                          self.num_steps - 1)
+            state += thres_i * self.stream_steps[i]
+
+        action = int(self.q_learner.Q[state, :].argmax())
+        new_pos = self.get_position(self.stream_position, action - 1)
+        self.stream_position += new_pos
+        return new_pos * self.num_shares
@@ -0,0 +1,178 @@
+"""Run hyperparameter sweeps of a StrategyLearner over a process pool"""
+
+import itertools
+import datetime as dt
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+import numpy as np
+import pandas as pd
+
+from util import get_data
+from QLearner import QLearner
+from strategy import StrategyLearner
+from marketsim import compute_portvals_single_symbol
+from analysis import get_portfolio_stats
+
+# Parameters of StrategyLearner and QLearner that can be swept, and their 
+# default values
+STRATEGY_PARAMS = {"window_size": 10, "num_steps": 10, "epochs": 100}
+LEARNER_PARAMS = {"alpha": 0.2, "gamma": 0.9, "rar": 0.5, "radr": 0.99, 
+                  "dyna": 0}
+
+# The prices shared with the worker processes, set by init_worker
+_shared_prices = None
+_shared_memory = None
+
+
+def grid_search(grid):
+    """Create a list of parameter dictionaries, one for each combination of the
+    values in grid, a dictionary whose values are lists.
+    """
+    names = list(grid)
+    return [dict(zip(names, values)) 
+            for values in itertools.product(*[grid[name] for name in names])]
+
+
+def random_search(space, n_iter, seed=None):
+    """Create a list of n_iter parameter dictionaries drawn at random from 
+    space. The value of each parameter in space is either a list to choose from
+    or a (low, high) tuple to draw uniformly from; if both bounds are ints, 
+    ints are drawn from [low, high].
+    """
+    rng = np.random.default_rng(seed)
+    jobs = []
+    for i in range(n_iter):
+        params = {}
+        for name, values in space.items():
+            if isinstance(values, tuple):
+                low, high = values
+                if isinstance(low, int) and isinstance(high, int):
+                    params[name] = int(rng.integers(low, high + 1))
+                else:
+                    params[name] = float(rng.uniform(low, high))
+            else:
+                params[name] = values[rng.integers(len(values))]
+        jobs.append(params)
+    return jobs
+
+
+def init_worker(name, shape, index, columns):
+    """Attach a worker process to the prices in shared memory."""
+    global _shared_prices, _shared_memory
+    _shared_memory = shared_memory.SharedMemory(name=name)
+    values = np.ndarray(shape, dtype=np.float64, buffer=_shared_memory.buf)
+    _shared_prices = pd.DataFrame(values, index=pd.DatetimeIndex(index), 
+                                  columns=columns, copy=False)
+
+
+def get_trade_stats(df_trades, symbol, start_val, commission, impact, prices):
+    """Return the Sharpe ratio and cumulative return of a trades dataframe, or 
+    NaN and 0.0 if there are no trades.
+    """
+    if df_trades.empty:
+        return np.nan, 0.0
+    portvals = compute_portvals_single_symbol(df_orders=df_trades, 
+        symbol=symbol, start_val=start_val, commission=commission, 
+        impact=impact, prices=prices)
+    cum_return, avg_daily_ret, std_daily_ret, sharpe_ratio = \
+        get_portfolio_stats(portvals)
+    return sharpe_ratio, cum_return
+
+
+def run_job(params, seed, symbol, train_dates, test_dates, start_val, 
+            num_shares, commission, impact):
+    """Train and test a StrategyLearner with the given parameters on the 
+    shared prices.
+
+    Returns: A dictionary with the parameters, the seed and the train and test
+    Sharpe ratios and cumulative returns
+    """
+    strategy_params = dict(STRATEGY_PARAMS)
+    learner_params = dict(LEARNER_PARAMS)
+    for name, value in params.items():
+        if name in strategy_params:
+            strategy_params[name] = value
+        elif name in learner_params:
+            learner_params[name] = value
+        else:
+            raise ValueError("Unknown parameter: {}".format(name))
+
+    # There are 3 features and 3 positions
+    num_states = 3 * pow(strategy_params["num_steps"], 3)
+    learner = QLearner(num_states=num_states, num_actions=3, seed=seed, 
+                       **learner_params)
+    stl = StrategyLearner(num_shares=num_shares, 
+                          epochs=strategy_params["epochs"], 
+                          num_steps=strategy_params["num_steps"], 
+                          impact=impact, commission=commission, 
+                          learner=learner)
+    stl.window_size = strategy_params["window_size"]
+    stl.add_evidence(symbol=symbol, start_date=train_dates[0], 
+                     end_date=train_dates[1], start_val=start_val, 
+                     prices=_shared_prices)
+
+    result = dict(params, seed=seed)
+    for period, (start_date, end_date) in [("train", train_dates), 
+                                           ("test", test_dates)]:
+        df_trades = stl.test_policy(symbol=symbol, start_date=start_date,
+                                    end_date=end_date, start_val=start_val, 
+                                    prices=_shared_prices)
+        result[period + "_sharpe"], result[period + "_cum_return"] = \
+            get_trade_stats(df_trades, symbol, start_val, commission, impact, 
+                            _shared_prices)
+    return result
+
+
+def run_sweep(jobs, symbol="SPY", train_dates=(dt.datetime(2007,1,1), 
+              dt.datetime(2007,12,31)), test_dates=(dt.datetime(2008,1,1), 
+              dt.datetime(2008,12,31)), start_val=100000, num_shares=1000, 
+              commission=0.0, impact=0.0, seed=0, max_workers=None):
+    """Train and test a StrategyLearner for each set of parameters in jobs 
+    across a pool of processes.
+
+    The prices of symbol are read once and handed to the workers in shared 
+    memory. Each job gets its own seed for its QLearner, derived from seed, so
+    a sweep gives the same results however it is scheduled.
+
+    Parameters:
+    jobs: A list of parameter dictionaries, e.g. from grid_search() or 
+    random_search(). Keys are names in STRATEGY_PARAMS and LEARNER_PARAMS; 
+    missing ones take the default values
+    symbol: The stock symbol to act on
+    train_dates: The start and end dates of the training period
+    test_dates: The start and end dates of the testing period
+    start_val: Start value of the portfolio which contains only the symbol
+    num_shares: The number of shares that can be traded in one order
+    commission: The fixed amount in dollars charged for each transaction
+    impact: The amount the price moves against the trader compared to the
+    historical data at each transaction
+    seed: The seed the seeds of the jobs are derived from
+    max_workers: The number of processes; defaults to the number of CPUs
+
+    Returns:
+    df_results: A dataframe with one row per job with its parameters, seed and
+    the train and test Sharpe ratios and cumulative returns
+    """
+    dates = pd.date_range(min(train_dates[0], test_dates[0]), 
+                          max(train_dates[1], test_dates[1]))
+    df_prices = get_data([symbol], dates)
+    seeds = [int(child.generate_state(1)[0]) 
+             for child in np.random.SeedSequence(seed).spawn(len(jobs))]
+
+    shm = shared_memory.SharedMemory(create=True, 
+                                     size=max(df_prices.values.nbytes, 1))
+    try:
+        values = np.ndarray(df_prices.shape, dtype=np.float64, buffer=shm.buf)
+        values[:] = df_prices.values
+        with ProcessPoolExecutor(max_workers=max_workers, 
+                initializer=init_worker, initargs=(shm.name, df_prices.shape, 
+                df_prices.index.values, list(df_prices.columns))) as executor:
+            futures = [executor.submit(run_job, params, job_seed, symbol, 
+                                       train_dates, test_dates, start_val, 
+                                       num_shares, commission, impact)
+                       for params, job_seed in zip(jobs, seeds)]
+            results = [future.result() for future in futures]
+    finally:
+        shm.close()
+        shm.unlink()
+    return pd.DataFrame(results)
@@ -3,32 +3,363 @@
 """ Originally from https://github.com/ntrang086/q_learning_trading """
 
 import datetime as dt
+import io
+import json
 import os
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from collections import OrderedDict
 import pandas as pd
 import numpy as np
 
+BUNDLE_MAGIC = b"\x93BUNDLE\x01"
+
 def symbol_to_path(symbol, base_dir=None):
     """Return CSV file path given ticker symbol."""
     if base_dir is None:
         base_dir = os.environ.get("MARKET_DATA_DIR", '../data/')
     return os.path.join(base_dir, "{}.csv".format(str(symbol)))
 
-def get_data(symbols, dates, addSPY=True, colname = 'Adj Close'):
-    """Read stock data (adjusted close) for given symbols from CSV files."""
+def read_prices(symbol, colname='Adj Close'):
+    """Read a column of stock data for a symbol from its CSV file into a 
+    dataframe indexed by date with one column named after the symbol."""
+    df_temp = pd.read_csv(symbol_to_path(symbol), index_col='Date',
+            parse_dates=True, usecols=['Date', colname], na_values=['nan'])
+    return df_temp.rename(columns={colname: symbol})
+
+def symbol_to_store_path(symbol, base_dir=None):
+    """Return the directory of the binary store of a symbol, see 
+    convert_to_store()."""
+    if base_dir is None:
+        base_dir = os.environ.get("MARKET_STORE_DIR", os.path.join(
+            os.environ.get("MARKET_DATA_DIR", '../data/'), "store"))
+    return os.path.join(base_dir, str(symbol))
+
+def convert_to_store(symbols=None, base_dir=None, store_dir=None):
+    """Convert CSV files of stock data to a binary columnar store that 
+    read_store() can memory-map. Each symbol gets a directory with its dates 
+    sorted in ascending order as int64 nanoseconds in Date.npy, and one 
+    float64 array per other column, e.g. Adj Close.npy.
+
+    Parameters:
+    symbols: A list of symbols to convert. If None, all CSV files in base_dir
+    base_dir: The directory of the CSV files, see symbol_to_path()
+    store_dir: The directory of the store, see symbol_to_store_path()
+
+    Returns:
+    symbols: The list of symbols converted
+    """
+    if symbols is None:
+        csv_dir = symbol_to_path("", base_dir=base_dir)[:-len(".csv")]
+        symbols = sorted(name[:-len(".csv")] for name in os.listdir(csv_dir)
+                         if name.endswith(".csv"))
+    for symbol in symbols:
+        df = pd.read_csv(symbol_to_path(symbol, base_dir=base_dir), 
+            index_col='Date', parse_dates=True, na_values=['nan'])
+        df = df.sort_index(kind="mergesort")
+        path = symbol_to_store_path(symbol, base_dir=store_dir)
+        os.makedirs(path, exist_ok=True)
+        for column in df.columns:
+            np.save(os.path.join(path, column + ".npy"), 
+                    df[column].values.astype(np.float64))
+        # Dates are written last, so that a store is only used once complete
+        np.save(os.path.join(path, "Date.npy"), 
+                df.index.values.astype("datetime64[ns]").view(np.int64))
+    return symbols
+
+def has_store(symbol):
+    """Return whether symbol has a binary store that is at least as recent 
+    as its CSV file, if any."""
+    date_path = os.path.join(symbol_to_store_path(symbol), "Date.npy")
+    if not os.path.exists(date_path):
+        return False
+    csv_path = symbol_to_path(symbol)
+    return (not os.path.exists(csv_path) 
+            or os.stat(date_path).st_mtime_ns >= os.stat(csv_path).st_mtime_ns)
+
+def read_store(symbol, colname='Adj Close', start_date=None, end_date=None):
+    """Read a column of stock data for a symbol from its binary store into a 
+    dataframe indexed by date with one column named after the symbol, like 
+    read_prices. The arrays are memory-mapped and the rows between start_date
+    and end_date (inclusive) are found by binary search on the dates, so only
+    those rows are read from disk.
+    """
+    path = symbol_to_store_path(symbol)
+    dates = np.load(os.path.join(path, "Date.npy"), mmap_mode="r")
+    values = np.load(os.path.join(path, colname + ".npy"), mmap_mode="r")
+    start = 0 if start_date is None else np.searchsorted(
+        dates, pd.Timestamp(start_date).value, side="left")
+    end = len(dates) if end_date is None else np.searchsorted(
+        dates, pd.Timestamp(end_date).value, side="right")
+    index = pd.DatetimeIndex(np.asarray(dates[start:end]).view("datetime64[ns]"),
+                             name="Date")
+    return pd.DataFrame({symbol: values[start:end]}, index=index)
+
+def read_fields(symbol, keys, start_date=None, end_date=None):
+    """Read several columns of stock data for a symbol in one pass, from its 
+    binary store if it has one and from its CSV file otherwise, into a 
+    dataframe indexed by date with one float column per key. The rows are 
+    limited to start_date to end_date (inclusive) if given.
+    """
+    if has_store(symbol):
+        df = pd.concat([read_store(symbol, key, start_date, end_date)[symbol]
+                        for key in keys], axis=1, keys=keys)
+    else:
+        df = pd.read_csv(symbol_to_path(symbol), index_col='Date', 
+            parse_dates=True, usecols=['Date'] + list(keys), na_values=['nan'])
+        mask = np.ones(len(df), dtype=bool)
+        if start_date is not None:
+            mask &= df.index >= start_date
+        if end_date is not None:
+            mask &= df.index <= end_date
+        df = df.loc[mask]
+    return df[list(keys)].astype(np.float64)
+
+class PriceCache(object):
+
+    def __init__(self, max_bytes=256 * 2**20):
+        """The constructor PriceCache() creates a cache of the data returned by
+        read_prices, keyed by file path, modification time and column, that 
+        holds at most max_bytes of data and evicts the least recently used 
+        entries first. A file modified since it was cached is read again.
+        """
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def read(self, symbol, colname='Adj Close'):
+        """Return the data of a symbol as read_prices does, from the cache if
+        the file has not changed since it was read. The returned dataframe is 
+        shared with the cache and must not be modified."""
+        path = symbol_to_path(symbol)
+        key = (path, colname)
+        mtime = os.stat(path).st_mtime_ns
+        entry = self.entries.get(key)
+        if entry is not None and entry[0] == mtime:
+            self.hits += 1
+            self.entries.move_to_end(key)
+            return entry[1]
+        self.misses += 1
+        if entry is not None:
+            self.evict(key)
+        df = read_prices(symbol, colname)
+        nbytes = int(df.memory_usage(index=True).sum())
+        if nbytes <= self.max_bytes:
+            while self.nbytes + nbytes > self.max_bytes:
+                self.evict(next(iter(self.entries)))
+            self.entries[key] = (mtime, df, nbytes)
+            self.nbytes += nbytes
+        return df
+
+    def evict(self, key):
+        """Remove the entry of key, a (path, colname) pair, from the cache."""
+        self.nbytes -= self.entries.pop(key)[2]
+
+    def clear(self):
+        """Empty the cache and reset the hit and miss counters."""
+        self.entries.clear()
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def info(self):
+        """Return a dictionary with the hits, misses, number of entries, bytes
+        used and byte budget of the cache."""
+        return {"hits": self.hits, "misses": self.misses, 
+                "entries": len(self.entries), "nbytes": self.nbytes, 
+                "max_bytes": self.max_bytes}
+
+# Process-wide cache used by get_data. The byte budget can be set with the 
+# PRICE_CACHE_BYTES environment variable, or by changing max_bytes
+price_cache = PriceCache(int(os.environ.get("PRICE_CACHE_BYTES", 256 * 2**20)))
+
+def get_data(symbols, dates, addSPY=True, colname = 'Adj Close', read=None):
+    """Read stock data (adjusted close) for given symbols from CSV files.
+    read(symbol, colname) returns the data of one symbol as read_prices does.
+    By default the data of symbols with a binary store (see convert_to_store)
+    is memory-mapped from it, and otherwise read through price_cache, so each 
+    file is parsed once until it changes or is evicted."""
     df = pd.DataFrame(index=dates)
     if addSPY and 'SPY' not in symbols:  # add SPY for reference, if absent
         symbols = ['SPY'] + symbols
 
     for symbol in symbols:
-        df_temp = pd.read_csv(symbol_to_path(symbol), index_col='Date',
-                parse_dates=True, usecols=['Date', colname], na_values=['nan'])
-        df_temp = df_temp.rename(columns={colname: symbol})
+        if read is not None:
+            df_temp = read(symbol, colname)
+        elif has_store(symbol):
+            df_temp = read_store(symbol, colname, df.index.min(), df.index.max())
+        else:
+            df_temp = price_cache.read(symbol, colname)
         df = df.join(df_temp)
         if symbol == 'SPY':  # drop dates SPY did not trade
             df = df.dropna(subset=["SPY"])
 
     return df
 
+def load_symbol(symbol, colname='Adj Close', start_date=None, end_date=None):
+    """Read a column of stock data for a symbol as get_universe does, timing 
+    it.
+
+    Returns:
+    symbol: The symbol
+    df_temp: A dataframe as returned by read_prices, or None if the symbol 
+    has neither a binary store nor a CSV file
+    seconds: The time taken to read it
+    """
+    start = time.perf_counter()
+    if has_store(symbol):
+        df_temp = read_store(symbol, colname, start_date, end_date)
+    elif os.path.exists(symbol_to_path(symbol)):
+        df_temp = read_prices(symbol, colname)
+    else:
+        df_temp = None
+    return symbol, df_temp, time.perf_counter() - start
+
+def get_universe(symbols, dates, addSPY=True, colname='Adj Close', 
+    max_workers=None, processes=False):
+    """Read stock data for a large number of symbols concurrently, aligned on
+    the trading days of SPY.
+
+    Unlike get_data, the files are parsed in parallel (the CSV parser releases
+    the GIL, so threads are usually enough) and the result is assembled with 
+    one concatenation instead of one join per symbol. Missing files are 
+    reported instead of raising.
+
+    Parameters:
+    symbols: A list of symbols of interest
+    dates: A list of dates of interest
+    addSPY: Whether to keep the SPY column in the result
+    colname: The type of data of interest, e.g. Adj Close, Volume, etc.
+    max_workers: The number of threads or processes, see 
+    concurrent.futures
+    processes: Whether to use a process pool instead of a thread pool
+
+    Returns:
+    df_prices: A dataframe with the trading days of SPY among dates as 
+    indices and the symbols found as columns
+    df_report: A dataframe indexed by symbol with the seconds taken to load
+    each symbol, its number of rows on those days and whether it is missing
+    """
+    index = pd.DataFrame(index=dates).index
+    start_date, end_date = index.min(), index.max()
+    symbols = list(symbols)
+    all_symbols = symbols if 'SPY' in symbols else ['SPY'] + symbols
+    pool = ProcessPoolExecutor if processes else ThreadPoolExecutor
+    with pool(max_workers=max_workers) as executor:
+        results = list(executor.map(load_symbol, all_symbols, 
+            [colname] * len(all_symbols), [start_date] * len(all_symbols), 
+            [end_date] * len(all_symbols)))
+    loaded = {symbol: df_temp for symbol, df_temp, _ in results}
+
+    # Trading days of SPY among dates
+    if loaded['SPY'] is None:
+        raise IOError("No data for SPY: {}".format(symbol_to_path('SPY')))
+    spy = loaded['SPY']['SPY'].reindex(index)
+    calendar = spy.index[spy.notna().values]
+
+    # Keep the first column of each symbol's data and align all on the 
+    # calendar at once
+    columns = [symbol for symbol in all_symbols if loaded[symbol] is not None
+               and (addSPY or symbol != 'SPY')]
+    df_prices = pd.concat([loaded[symbol].iloc[:, 0].reindex(calendar) 
+                           for symbol in columns], axis=1, keys=columns)
+
+    df_report = pd.DataFrame({
+        "seconds": [seconds for _, _, seconds in results],
+        "rows": [0 if df_temp is None else 
+                 int(df_temp.iloc[:, 0].reindex(calendar).notna().sum()) 
+                 for _, df_temp, _ in results],
+        "missing": [df_temp is None for _, df_temp, _ in results]}, 
+        index=pd.Index(all_symbols, name="Symbol"))
+    return df_prices, df_report
+
+class PriceProvider(object):
+
+    def __init__(self):
+        """The constructor PriceProvider() creates an in-memory store of stock 
+        data that loads each symbol's data at most once per column, from its 
+        binary store if it has one and through price_cache otherwise. Unlike 
+        price_cache, the data is kept for the life of the provider whatever 
+        its size. Pass it as prices to the functions that accept one, so that
+        a session of training, testing and benchmarking loads each symbol once.
+        """
+        self.data = {}
+
+    def read(self, symbol, colname='Adj Close'):
+        """Return the data of a symbol as read_prices does, loading it the 
+        first time only."""
+        if (symbol, colname) not in self.data:
+            if has_store(symbol):
+                df_temp = read_store(symbol, colname)
+            else:
+                df_temp = price_cache.read(symbol, colname)
+            self.data[(symbol, colname)] = df_temp
+        return self.data[(symbol, colname)]
+
+    def get_data(self, symbols, dates, addSPY=True, colname='Adj Close'):
+        """Return what get_data(symbols, dates, addSPY, colname) would."""
+        return get_data(symbols, dates, addSPY=addSPY, colname=colname, 
+                        read=self.read)
+
+def iter_price_bars(symbol, colname='Adj Close', chunksize=100000):
+    """Yield one (timestamp, price) bar per row of the data of a symbol, 
+    chunksize rows at a time, so files of any length can be streamed, e.g. 
+    into marketsim.stream_portvals(). Bars are read from the binary store of 
+    the symbol if it has one (see convert_to_store), which is sorted by date.
+    Otherwise they are read from its CSV file in file order, which may not be
+    sorted: data/SPY.csv is stored newest first, so convert it to the store 
+    before streaming it.
+    """
+    if has_store(symbol):
+        path = symbol_to_store_path(symbol)
+        dates = np.load(os.path.join(path, "Date.npy"), mmap_mode="r")
+        values = np.load(os.path.join(path, colname + ".npy"), mmap_mode="r")
+        for start in range(0, len(dates), chunksize):
+            timestamps = pd.DatetimeIndex(np.asarray(
+                dates[start:start + chunksize]).view("datetime64[ns]"))
+            for timestamp, price in zip(timestamps, 
+                                        values[start:start + chunksize]):
+                yield timestamp, price
+        return
+    for df_chunk in pd.read_csv(symbol_to_path(symbol), index_col='Date', 
+            parse_dates=True, usecols=['Date', colname], na_values=['nan'],
+            chunksize=chunksize):
+        for timestamp, price in zip(df_chunk.index, df_chunk[colname].values):
+            yield timestamp, price
+
+def select_prices(prices, dates):
+    """Select the rows of an already loaded price dataframe, e.g. the result of
+    get_data over a longer period, that fall between the first and last of the
+    given dates, so that it can be used in place of get_data(symbols, dates).
+    """
+    dates = pd.DatetimeIndex(dates)
+    return prices[(prices.index >= dates.min()) & (prices.index <= dates.max())]
+
+def load_prices(symbols, dates, prices=None, addSPY=True):
+    """Return adjusted close prices like get_data(symbols, dates, addSPY), 
+    from prices if given.
+
+    Parameters:
+    symbols: A list of symbols of interest
+    dates: A list of dates of interest
+    prices: None to read the prices from disk, a PriceProvider, or a 
+    dataframe of already loaded prices with a column for each symbol, as 
+    returned by get_data over a period covering dates
+    addSPY: Whether to add SPY for reference and drop dates SPY did not trade
+
+    Returns:
+    df_prices: A dataframe with dates as indices and symbols as columns
+    """
+    if prices is None:
+        return get_data(symbols, dates, addSPY=addSPY)
+    if isinstance(prices, PriceProvider):
+        return prices.get_data(symbols, dates, addSPY=addSPY)
+    if addSPY and 'SPY' not in symbols and 'SPY' in prices.columns:
+        symbols = ['SPY'] + symbols
+    return select_prices(prices, dates)[symbols].copy()
+
 def get_orders_data_file(basefilename):
     return open(os.path.join(os.environ.get("ORDERS_DATA_DIR",'orders/'),basefilename))
 
@@ -97,10 +428,84 @@ def load_txt_data(dirpath, filename):
     return np_data
 
 
+class TradingCalendar(object):
+
+    def __init__(self, dates):
+        """The constructor TradingCalendar(dates) creates a calendar of the 
+        trading days of an exchange, stored as a sorted numpy datetime64 array
+        so that queries are binary searches.
+
+        Parameters:
+        dates: A list or array of the days the exchange traded, in any order
+        """
+        self.dates = np.unique(pd.DatetimeIndex(dates).values)
+
+    @classmethod
+    def from_file(cls, dirpath="../data/dates_lists", filename="NYSE_dates.txt"):
+        """Create a calendar from a text file with one date (mm/dd/yyyy) per 
+        line, such as NYSE_dates.txt."""
+        return cls(pd.to_datetime(load_txt_data(dirpath, filename), 
+                                  format="%m/%d/%Y"))
+
+    @classmethod
+    def from_prices(cls, symbol="SPY"):
+        """Create a calendar from the days on which symbol has a price."""
+        if has_store(symbol):
+            df_temp = read_store(symbol)
+        else:
+            df_temp = price_cache.read(symbol)
+        return cls(df_temp.index[df_temp[symbol].notna().values])
+
+    def range(self, start_date=None, end_date=None):
+        """Return a DatetimeIndex of the trading days between start_date and 
+        end_date (inclusive)."""
+        start = 0 if start_date is None else np.searchsorted(
+            self.dates, np.datetime64(pd.Timestamp(start_date)), side="left")
+        end = len(self.dates) if end_date is None else np.searchsorted(
+            self.dates, np.datetime64(pd.Timestamp(end_date)), side="right")
+        return pd.DatetimeIndex(self.dates[start:end])
+
+    def is_session(self, date):
+        """Return whether the exchange traded on date."""
+        i = np.searchsorted(self.dates, np.datetime64(pd.Timestamp(date)))
+        return i < len(self.dates) and self.dates[i] == np.datetime64(
+            pd.Timestamp(date))
+
+    def next_session(self, date):
+        """Return the first trading day after date, or None if there is none
+        in the calendar."""
+        i = np.searchsorted(self.dates, np.datetime64(pd.Timestamp(date)), 
+                            side="right")
+        return pd.Timestamp(self.dates[i]) if i < len(self.dates) else None
+
+    def previous_session(self, date):
+        """Return the last trading day before date, or None if there is none 
+        in the calendar."""
+        i = np.searchsorted(self.dates, np.datetime64(pd.Timestamp(date)), 
+                            side="left")
+        return pd.Timestamp(self.dates[i - 1]) if i > 0 else None
+
+# Calendars built by get_calendar, by dates file
+calendars = {}
+
+def get_calendar(dirpath="../data/dates_lists", filename="NYSE_dates.txt"):
+    """Return the trading calendar of the dates file in dirpath, built on the 
+    first call only. If the file does not exist, the calendar is derived from
+    the days SPY traded instead, which only covers the SPY data available.
+    """
+    filepath = os.path.join(dirpath, filename)
+    if filepath not in calendars:
+        if os.path.exists(filepath):
+            calendars[filepath] = TradingCalendar.from_file(dirpath, filename)
+        else:
+            calendars[filepath] = TradingCalendar.from_prices("SPY")
+    return calendars[filepath]
+
 def get_exchange_days(start_date = dt.datetime(1964,7,5), end_date = dt.datetime(2020,12,31),
     dirpath = "../data/dates_lists", filename="NYSE_dates.txt"):
     """ Create a list of dates between start_date and end_date (inclusive) that correspond 
     to the dates there was trading at an exchange. Default values are given based on NYSE.
+    See get_calendar() for what happens if the file is missing.
 
     Parameters:
     start_date: First timestamp to consider (inclusive)
@@ -111,15 +516,7 @@ def get_exchange_days(start_date = dt.datetime(1964,7,5), end_date = dt.datetime
     Returns:
     dates: A list of dates between start_date and end_date on which an exchange traded
     """
-
-    # Load a text file located in dirpath
-    dates_str = load_txt_data(dirpath, filename)
-    all_dates_frome_file = [dt.datetime.strptime(date, "%m/%d/%Y") for date in dates_str]
-    df_all_dates = pd.Series(index=all_dates_frome_file, data=all_dates_frome_file)
-
-    selected_dates = [date for date in df_all_dates[start_date:end_date]]
-
-    return selected_dates
+    return list(get_calendar(dirpath, filename).range(start_date, end_date))
 
 
 def get_data_as_dict(dates, symbols, keys):
@@ -136,24 +533,28 @@ def get_data_as_dict(dates, symbols, keys):
     values are dataframes with dates as indices and symbols as columns
     """
 
+    # Each symbol is read once for all keys and written into one preallocated
+    # (dates x symbols) block per key
+    index = pd.DataFrame(index=dates).index
+    blocks = np.full((len(keys), len(index), len(symbols)), np.nan)
+    for i, symbol in enumerate(symbols):
+        df_temp = read_fields(symbol, keys, index.min(), index.max())
+        blocks[:, :, i] = df_temp.reindex(index).values.T
+
     data_dict = {}
-    for key in keys:
-        df = pd.DataFrame(index=dates)
-        for symbol in symbols:
-            df_temp = pd.read_csv(symbol_to_path(symbol), index_col="Date",
-                    parse_dates=True, usecols=["Date", key], na_values=["nan"])
-            df_temp = df_temp.rename(columns={key: symbol})
-            df = df.join(df_temp) 
-        data_dict[key] = df
+    for j, key in enumerate(keys):
+        data_dict[key] = pd.DataFrame(blocks[j], index=index, columns=symbols)
     return data_dict
 
-def create_df_benchmark(symbol, start_date, end_date, num_shares):
+def create_df_benchmark(symbol, start_date, end_date, num_shares, prices=None):
     """Create a dataframe of benchmark data. Benchmark is a portfolio consisting of
-    num_shares of the symbol in use and holding them until end_date.
+    num_shares of the symbol in use and holding them until end_date. prices 
+    can be a PriceProvider or a dataframe of already loaded prices, see 
+    load_prices().
     """
     # Get adjusted close price data
-    benchmark_prices = get_data([symbol], pd.date_range(start_date, end_date), 
-                                addSPY=False).dropna()
+    benchmark_prices = load_prices([symbol], pd.date_range(start_date, end_date), 
+                                   prices=prices, addSPY=False).dropna()
     # Create benchmark df: buy num_shares and hold them till the last date
     df_benchmark_trades = pd.DataFrame(
         data=[(benchmark_prices.index.min(), num_shares), 
@@ -177,3 +578,74 @@ def create_df_trades(orders, symbol, num_shares, cash_pos=0, long_pos=1, short_p
     df_trades = pd.DataFrame(trades, columns=["Date", "Shares"])
     df_trades.set_index("Date", inplace=True)
     return df_trades
+
+def save_bundle(path, arrays, header=None, align=64):
+    """Save numpy arrays and a small header to a single binary file. The file
+    starts with a magic string, the length of a JSON header and the header 
+    itself, followed by each array in .npy format at an offset that is a 
+    multiple of align bytes, so that the arrays can be memory-mapped.
+
+    Parameters:
+    path: The path of the file to write
+    arrays: A dictionary whose keys are names and values are numpy arrays
+    header: A dictionary of JSON serializable values to store with the arrays
+    align: The alignment in bytes of each array in the file
+    """
+    # Serialize every array to find its offset from the start of the data
+    blobs = {}
+    offsets = {}
+    size = 0
+    for name, array in arrays.items():
+        buf = io.BytesIO()
+        np.lib.format.write_array(buf, np.ascontiguousarray(array), 
+                                  allow_pickle=False)
+        blobs[name] = buf.getvalue()
+        offsets[name] = size
+        size += len(blobs[name]) + (-len(blobs[name])) % align
+
+    header_bytes = json.dumps({"header": header or {}, "offsets": offsets, 
+                               "align": align}).encode()
+    start = len(BUNDLE_MAGIC) + 8 + len(header_bytes)
+    start += (-start) % align
+    with open(path, "wb") as f:
+        f.write(BUNDLE_MAGIC)
+        f.write(np.uint64(len(header_bytes)).tobytes())
+        f.write(header_bytes)
+        for name, blob in blobs.items():
+            f.seek(start + offsets[name])
+            f.write(blob)
+
+def load_bundle(path, mmap_names=()):
+    """Load the arrays and header of a file written by save_bundle.
+
+    Parameters:
+    path: The path of the file to read
+    mmap_names: The names of the arrays to memory-map read-only instead of 
+    reading them into memory
+
+    Returns:
+    arrays: A dictionary whose keys are names and values are numpy arrays
+    header: The dictionary stored with the arrays
+    """
+    arrays = {}
+    with open(path, "rb") as f:
+        if f.read(len(BUNDLE_MAGIC)) != BUNDLE_MAGIC:
+            raise ValueError("{} is not a bundle file".format(path))
+        header_len = int(np.frombuffer(f.read(8), dtype=np.uint64)[0])
+        content = json.loads(f.read(header_len).decode())
+        start = f.tell() + (-f.tell()) % content["align"]
+        for name, offset in content["offsets"].items():
+            f.seek(start + offset)
+            if name in mmap_names:
+                if np.lib.format.read_magic(f) == (1, 0):
+                    shape, fortran_order, dtype = \
+                        np.lib.format.read_array_header_1_0(f)
+                else:
+                    shape, fortran_order, dtype = \
+                        np.lib.format.read_array_header_2_0(f)
+                arrays[name] = np.memmap(path, dtype=dtype, mode="r", 
+                    offset=f.tell(), shape=shape, 
+                    order="F" if fortran_order else "C")
+            else:
+                arrays[name] = np.lib.format.read_array(f, allow_pickle=False)
+    return arrays, content["header"]
@@ -0,0 +1,110 @@
+"""Retrain a StrategyLearner over a rolling window and test it out of sample"""
+
+import datetime as dt
+import numpy as np
+import pandas as pd
+
+from util import load_prices
+
+
+class SortedWindow(object):
+
+    def __init__(self, values):
+        """The constructor SortedWindow() keeps each column of a 2-d numpy array
+        of feature values sorted, so that rows can be added to and removed from
+        a rolling window without sorting it again.
+
+        Parameters:
+        values: A 2-d numpy array with days as rows and features as columns
+        """
+        self.columns = [np.sort(values[:, i]) for i in range(values.shape[1])]
+
+    def add(self, values):
+        """Insert the rows of a 2-d numpy array."""
+        for i, column in enumerate(self.columns):
+            new = np.sort(values[:, i])
+            self.columns[i] = np.insert(column, np.searchsorted(column, new), new)
+
+    def remove(self, values):
+        """Remove the rows of a 2-d numpy array, which must be in the window."""
+        for i, column in enumerate(self.columns):
+            old = np.sort(values[:, i])
+            # Equal values are removed from consecutive positions
+            rank = np.arange(len(old)) - np.searchsorted(old, old)
+            self.columns[i] = np.delete(column, 
+                                        np.searchsorted(column, old) + rank)
+
+    def values(self):
+        """Return a 2-d numpy array whose columns are the sorted features."""
+        return np.column_stack(self.columns)
+
+
+def walk_forward(strategy, symbol="SPY", start_date=dt.datetime(2005,1,1),
+    end_date=dt.datetime(2012,9,12), train_days=252, step_days=21, 
+    start_val=100000, prices=None):
+    """Retrain a StrategyLearner every step_days trading days on the previous 
+    train_days days and use it to trade the next step_days days.
+
+    The features are computed once over the whole period and the sorted 
+    feature values behind the thresholds are updated as the window rolls 
+    forward. Each fold continues training the Q-table of the previous fold 
+    rather than starting from scratch.
+
+    Parameters:
+    strategy: The StrategyLearner to train, e.g. a new StrategyLearner
+    symbol: The stock symbol to act on
+    start_date: A datetime object that represents the start date
+    end_date: A datetime object that represents the end date
+    train_days: The number of trading days in each training window
+    step_days: The number of trading days between retrainings, i.e. the 
+    length of each out-of-sample period
+    start_val: Start value of the portfolio which contains only the symbol
+    prices: A PriceProvider or a dataframe of adjusted close prices with a 
+    column for symbol, as returned by get_data. If None, prices are read from 
+    disk
+
+    Returns:
+    df_trades: A dataframe of the out-of-sample trades of all folds, as 
+    returned by StrategyLearner.test_policy(). Each fold closes its position
+    on its last day
+    df_folds: A dataframe with the training and testing dates and the final 
+    training cumulative return of each fold
+    """
+    df_prices = load_prices([symbol], pd.date_range(start_date, end_date), 
+                            prices=prices)[symbol]
+    df_features = strategy.get_features(df_prices)
+    values = df_features.values
+    if len(df_features) <= train_days:
+        raise ValueError("walk_forward needs more than train_days={} days of "
+            "features, but only {} are available between {} and {}".format(
+            train_days, len(df_features), start_date, end_date))
+
+    trades = []
+    folds = []
+    window = None
+    for start in range(0, len(df_features) - train_days, step_days):
+        end = start + train_days
+        # Roll the window forward to [start, end)
+        if window is None or step_days >= train_days:
+            window = SortedWindow(values[start:end])
+        else:
+            window.remove(values[start - step_days:start])
+            window.add(values[end - step_days:end])
+        thresholds = strategy.get_thresholds_from_sorted(window.values(), 
+                                                         strategy.num_steps)
+        # Pass the prices from the start row of the fold on; train() pairs 
+        # them with the features row by row, as add_evidence does with all the
+        # prices of its period
+        strategy.train(df_features.iloc[start:end], df_prices.iloc[start:], 
+                       thresholds, start_val)
+
+        df_test = df_features.iloc[end:end + step_days]
+        trades.append(strategy.get_trades(df_test, thresholds, symbol))
+        folds.append((df_features.index[start], df_features.index[end - 1],
+                      df_test.index[0], df_test.index[-1], 
+                      strategy.cum_returns[-1]))
+
+    df_trades = pd.concat(trades)
+    df_folds = pd.DataFrame(folds, columns=["train_start", "train_end", 
+        "test_start", "test_end", "train_cum_return"])
+    return df_trades, df_folds